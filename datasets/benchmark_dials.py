@@ -0,0 +1,220 @@
+#!/usr/bin/env python3
+
+
+# Benchmark the data retrieval of get_data_dials.py against a mock DIALS server
+# (see dials_mock.py), for the different fetch modes:
+# - serial: one request per run, one run at a time, all runs kept in memory.
+# - concurrent: one request per run, multiple runs at a time (see --workers).
+# - batched: one request per chunk of runs (see --lumisperrequest), one chunk at a time.
+# - streaming: as serial, but each run is written to the output file as soon as it is retrieved.
+# - async: one request per run, with the asynchronous fetch engine (see --inflight and dials_async.py).
+# For each mode, the wall time, the throughput (rows and MB per second)
+# and the peak memory usage (as measured by tracemalloc) are reported.
+# The wall time and the peak memory are measured in two separate passes,
+# since tracemalloc slows down the retrieval considerably.
+# The results can be written to a json file (--outputfile), and compared to
+# a previous result (--reference) to catch performance regressions.
+# note: tracemalloc only tracks memory allocated through python
+#       (including numpy and pandas), not the memory allocated by pyarrow;
+#       the mock server itself runs in the same process, so its overhead is included.
+
+
+# general imports
+import os
+import sys
+import json
+import time
+import shutil
+import argparse
+import tempfile
+import tracemalloc
+import pandas as pd
+
+# local imports
+import get_data_dials as gdd
+import dials_mock
+import dials_retry
+import dials_progress
+import dials_async
+
+
+def run_mode(mode, metype, dataset, me, workers=1, lumis_per_request=None, outputdir=None, engine=None):
+  ### retrieve all runs for a given dataset and ME in a given mode and write the output
+  # returns the number of rows and the estimated size (in bytes) of the retrieved data.
+  lscounts = gdd.get_runs(dataset)
+  runs = list(lscounts.keys())
+  if mode!='concurrent': workers = 1
+  if mode!='batched': lumis_per_request = None
+  if mode!='async': engine = None
+  writers = {}
+  dfs = []
+  nrows = 0
+  nbytes = 0
+  for run, df in gdd.iter_runs_data(metype, dataset, me, runs, workers=workers,
+                                    lscounts=lscounts, lumis_per_request=lumis_per_request,
+                                    engine=engine):
+    nrows += len(df)
+    nbytes += dials_progress.estimate_nbytes(df)
+    if mode=='streaming': gdd.write_streaming(writers, df, outputdir)
+    else: dfs.append(df)
+  if mode=='streaming': gdd.close_writers(writers)
+  else: gdd.write_partitions(pd.concat(dfs, ignore_index=True), outputdir)
+  return (nrows, nbytes)
+
+def measure(mode, metype, dataset, me, workers=1, lumis_per_request=None, inflight=16, trace=False):
+  ### run a given mode once and measure either the wall time or the peak memory
+  # returns a tuple of the number of rows, the estimated size (in bytes) of the retrieved data,
+  # the number of page requests, and either the wall time (in seconds; if trace is False)
+  # or the peak memory (in bytes, as measured by tracemalloc; if trace is True).
+  # note: for the async mode, the engine is started inside the measurement
+  #       (so its startup time and memory are included).
+  outputdir = tempfile.mkdtemp(prefix='benchmark_dials_')
+  nrequests = gdd.dials.nrequests
+  if trace: tracemalloc.start()
+  starttime = time.time()
+  engine = None
+  try:
+    if mode=='async': engine = dials_async.Engine(inflight=inflight)
+    (nrows, nbytes) = run_mode(mode, metype, dataset, me, workers=workers,
+                        lumis_per_request=lumis_per_request, outputdir=outputdir, engine=engine)
+    if trace: (_, measurement) = tracemalloc.get_traced_memory()
+    else: measurement = time.time() - starttime
+  finally:
+    if engine is not None: engine.close()
+    if trace: tracemalloc.stop()
+    shutil.rmtree(outputdir)
+  return (nrows, nbytes, gdd.dials.nrequests - nrequests, measurement)
+
+def benchmark(mode, metype, dataset, me, workers=1, lumis_per_request=None, inflight=16):
+  ### benchmark a given mode
+  # returns a dict with the results.
+  # note: the wall time is measured in a first pass without tracemalloc,
+  #       the peak memory in a second pass with tracemalloc.
+  kwargs = {'workers': workers, 'lumis_per_request': lumis_per_request, 'inflight': inflight}
+  (nrows, nbytes, nrequests, elapsed) = measure(mode, metype, dataset, me, trace=False, **kwargs)
+  (_, _, _, peak) = measure(mode, metype, dataset, me, trace=True, **kwargs)
+  return {
+    'mode': mode,
+    'time': elapsed,
+    'rows': nrows,
+    'mb': nbytes/1024**2,
+    'requests': nrequests,
+    'rows_per_second': nrows/elapsed,
+    'mb_per_second': nbytes/1024**2/elapsed,
+    'peak_memory_mb': peak/1024**2
+  }
+
+def compare(results, reference, tolerance):
+  ### compare results to a reference
+  # returns a list of messages for each regression
+  # (i.e. a throughput that is lower, or a peak memory that is higher, than in the reference
+  #  by more than the given relative tolerance).
+  messages = []
+  reference = {result['mode']: result for result in reference}
+  for result in results:
+    if result['mode'] not in reference: continue
+    ref = reference[result['mode']]
+    if result['rows_per_second']<ref['rows_per_second']*(1-tolerance):
+      msg = 'throughput for mode {} decreased from {:.1f} to {:.1f} rows/s'.format(
+            result['mode'], ref['rows_per_second'], result['rows_per_second'])
+      messages.append(msg)
+    if result['peak_memory_mb']>ref['peak_memory_mb']*(1+tolerance):
+      msg = 'peak memory for mode {} increased from {:.1f} to {:.1f} MB'.format(
+            result['mode'], ref['peak_memory_mb'], result['peak_memory_mb'])
+      messages.append(msg)
+  return messages
+
+
+if __name__=='__main__':
+
+  # read arguments
+  parser = argparse.ArgumentParser(description='Benchmark data retrieval')
+  parser.add_argument('--modes', default=['serial', 'concurrent', 'batched', 'streaming', 'async'], nargs='+',
+    choices=['serial', 'concurrent', 'batched', 'streaming', 'async'],
+    help='Fetch modes to benchmark (default: all).')
+  parser.add_argument('-t', '--metype', default='h2d', choices=['h1d', 'h2d'],
+    help='Type of the mock ME (default: h2d).')
+  parser.add_argument('--nbins', default=[72, 56], type=int, nargs='+',
+    help='Number of bins of the mock ME (one value for h1d, two values for h2d; default: 72 56).')
+  parser.add_argument('--nruns', default=20, type=int,
+    help='Number of runs in the mock dataset (default: 20).')
+  parser.add_argument('--lumis', default=[50, 200], type=int, nargs='+',
+    help='Number of lumisections per run in the mock dataset'
+        +' (one value, or two values for a random number in a range; default: 50 200).')
+  parser.add_argument('--latency', default=0.05, type=float,
+    help='Latency per page request in seconds (default: 0.05).')
+  parser.add_argument('--pagesize', default=100, type=int,
+    help='Number of results per page (default: 100).')
+  parser.add_argument('--errorrate', default=0., type=float,
+    help='Probability of a transient error per page request (default: 0).')
+  parser.add_argument('--workers', default=4, type=int,
+    help='Number of workers for the concurrent mode (default: 4).')
+  parser.add_argument('--inflight', default=16, type=int,
+    help='Maximum number of page requests in flight for the async mode (default: 16).')
+  parser.add_argument('--lumisperrequest', default=500, type=int,
+    help='Targeted number of lumisections per request for the batched mode (default: 500).')
+  parser.add_argument('--outputfile', default=None,
+    help='Path to a json file to write the results to.')
+  parser.add_argument('--reference', default=None,
+    help='Path to a json file with reference results (written earlier with --outputfile);'
+        +' the script exits with a nonzero exit code in case of a regression.')
+  parser.add_argument('--tolerance', default=0.2, type=float,
+    help='Relative tolerance for the comparison with the reference (default: 0.2).')
+  args = parser.parse_args()
+
+  # print arguments
+  print('Running with following configuration:')
+  for arg in vars(args):
+    print('  - {}: {}'.format(arg,getattr(args,arg)))
+
+  # set up the mock server
+  dataset = '/ZeroBias/Run2024A-PromptReco-v1/DQMIO'
+  me = 'Mock/{}_benchmark'.format(args.metype)
+  if args.metype=='h1d': shape = args.nbins[0]
+  else: shape = tuple(args.nbins[:2])
+  lumis = args.lumis[0] if len(args.lumis)==1 else tuple(args.lumis[:2])
+  gdd.dials = dials_mock.MockDials(datasets=[dataset], runs=list(range(380000, 380000+args.nruns)),
+                lumis=lumis, mes={me: shape}, latency=args.latency,
+                page_size=args.pagesize, error_rate=args.errorrate)
+  dials_retry.configure(base_delay=0.01, max_delay=0.1, verbose=False)
+
+  # run the benchmarks
+  # note: the output of the retrieval itself is suppressed.
+  results = []
+  for mode in args.modes:
+    print('Running mode {}...'.format(mode))
+    sys.stdout.flush()
+    stdout = sys.stdout
+    with open(os.devnull, 'w') as devnull:
+      sys.stdout = devnull
+      try:
+        result = benchmark(mode, args.metype, dataset, me, workers=args.workers,
+                   lumis_per_request=args.lumisperrequest, inflight=args.inflight)
+      finally:
+        sys.stdout = stdout
+    results.append(result)
+
+  # print the results
+  print('{:<12} {:>8} {:>8} {:>8} {:>9} {:>10} {:>8} {:>10}'.format(
+        'mode', 'time (s)', 'rows', 'MB', 'requests', 'rows/s', 'MB/s', 'peak (MB)'))
+  for result in results:
+    print('{:<12} {:>8.2f} {:>8} {:>8.1f} {:>9} {:>10.1f} {:>8.2f} {:>10.1f}'.format(
+          result['mode'], result['time'], result['rows'], result['mb'], result['requests'],
+          result['rows_per_second'], result['mb_per_second'], result['peak_memory_mb']))
+
+  # write the results
+  if args.outputfile is not None:
+    with open(args.outputfile, 'w') as f:
+      json.dump(results, f, indent=2)
+    print('Written results to {}'.format(args.outputfile))
+
+  # compare to reference
+  if args.reference is not None:
+    with open(args.reference, 'r') as f:
+      reference = json.load(f)
+    messages = compare(results, reference, args.tolerance)
+    if len(messages)==0: print('No regressions with respect to {}'.format(args.reference))
+    else:
+      print('Found regressions with respect to {}:'.format(args.reference))
+      for msg in messages: print('  - {}'.format(msg))
+      sys.exit(1)
@@ -0,0 +1,137 @@
+#!/usr/bin/env python3
+
+
+# Asynchronous fetch engine for DIALS requests
+# - An asyncio event loop runs in a background thread, and schedules
+#   the pages of many DIALS requests at the same time,
+#   with a bound on the number of page requests that are in flight.
+# - The cmsdials api itself is blocking, so each page request is made
+#   in a thread pool (of the same size as the bound on the in-flight requests),
+#   with rate limiting as usual (see dials_ratelimit.py);
+#   requests that are waiting for a free slot are cheap coroutines instead of threads,
+#   so that many requests can be queued from a single process.
+# - Failed page requests are retried with the same policy as in dials_retry.py,
+#   but the backoff delay between attempts is awaited in the event loop,
+#   without holding an in-flight slot or a thread (see call_with_retry).
+# - Note: this only overlaps the waiting for the server; the cmsdials api opens
+#   a new HTTP session for each page request, so the connections are not reused.
+# - Results are handed back to the (synchronous) caller as concurrent futures,
+#   so they can be consumed (e.g. written to the output files) as soon as they are ready.
+#
+# Usage example:
+#   engine = dials_async.Engine(inflight=64)
+#   future = engine.submit(dials_async.list_pages(engine, dials.h2d, filters))
+#   data = future.result()
+#   engine.close()
+# see also iter_runs_data in get_data_dials.py.
+
+
+# general imports
+import asyncio
+import time
+import functools
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+# local imports
+import dials_retry
+import dials_ratelimit
+
+
+class Engine(object):
+  ### event loop in a background thread, with a thread pool for the blocking calls
+
+  def __init__(self, inflight=32):
+    ### initializer
+    # input arguments:
+    # - inflight: maximum number of page requests in flight at the same time.
+    self.inflight = inflight
+    self.executor = ThreadPoolExecutor(max_workers=inflight)
+    self.loop = asyncio.new_event_loop()
+    self.loop.set_default_executor(self.executor)
+    self.thread = threading.Thread(target=self.loop.run_forever, daemon=True)
+    self.thread.start()
+    self.semaphore = self.submit(self.make_semaphore()).result()
+
+  async def make_semaphore(self):
+    ### make the semaphore bounding the in-flight requests
+    # note: made inside the event loop, so that it is bound to it.
+    return asyncio.Semaphore(self.inflight)
+
+  def submit(self, coroutine):
+    ### schedule a coroutine on the event loop
+    # returns a concurrent.futures.Future, that can be waited for from any thread
+    # (and cancelled, which also cancels the coroutine).
+    return asyncio.run_coroutine_threadsafe(coroutine, self.loop)
+
+  async def request(self, func, *args, **kwargs):
+    ### make a blocking request in the thread pool, respecting the in-flight bound
+    async with self.semaphore:
+      return await self.run(func, *args, **kwargs)
+
+  async def run(self, func, *args, **kwargs):
+    ### run a blocking function in the thread pool, without the in-flight bound
+    # (e.g. for converting a response to a dataframe)
+    return await self.loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+
+  def close(self):
+    ### cancel all pending coroutines, stop the event loop and the thread pool
+    # note: blocking requests that are already running are allowed to finish.
+    async def cancel_all():
+      tasks = [task for task in asyncio.all_tasks() if task is not asyncio.current_task()]
+      for task in tasks: task.cancel()
+      await asyncio.gather(*tasks, return_exceptions=True)
+    if self.loop.is_closed(): return
+    self.submit(cancel_all()).result()
+    self.loop.call_soon_threadsafe(self.loop.stop)
+    self.thread.join()
+    self.loop.close()
+    self.executor.shutdown(wait=True, cancel_futures=True)
+
+
+async def call_with_retry(engine, func, description='request', max_attempts=None, stats=None):
+  ### call func() (a blocking function without arguments) through the engine, with retries
+  # same as dials_retry.call_with_retry, but each attempt is made with engine.request,
+  # so that an in-flight slot (and a thread) is only held while the request is made,
+  # and not during the backoff delay before the next attempt.
+  if max_attempts is None: max_attempts = dials_retry.config['max_attempts']
+  attempt = 0
+  while True:
+    attempt += 1
+    timing = {}
+    def call():
+      with dials_ratelimit.limit():
+        # note: the timing excludes the time spent waiting for the rate limiter
+        timing['start'] = time.time()
+        return func()
+    try: result = await engine.request(call)
+    except Exception as exc:
+      duration = time.time() - timing.get('start', time.time())
+      delay = dials_retry.handle_failure(exc, description, attempt, max_attempts, duration, stats=stats)
+      if delay is None: raise
+      await asyncio.sleep(delay)
+      continue
+    dials_retry.handle_success(description, attempt, max_attempts, time.time()-timing['start'])
+    return result
+
+async def list_pages(engine, client, filters, max_pages=None, description=None, max_attempts=None, stats=None):
+  ### retrieve all pages of a paginated request, with retries per page
+  # same as dials_retry.list_pages, but each page is requested through the engine,
+  # so that the pages of many requests are retrieved concurrently.
+  # note: the pages of a single request are still retrieved one after the other,
+  #       since the url of each page is only known from the previous page.
+  if description is None: description = dials_retry.describe(filters)
+  results = []
+  page_filters = filters
+  npages = 0
+  while True:
+    pagedescription = '{} (page {})'.format(description, npages+1)
+    response = await call_with_retry(engine, functools.partial(client.list, page_filters),
+                 description=pagedescription, max_attempts=max_attempts, stats=stats)
+    results += response.results
+    npages += 1
+    if stats is not None: stats['pages'] = stats.get('pages', 0) + 1
+    if response.next is None: break
+    if( max_pages is not None and npages>=max_pages ): break
+    page_filters = dials_retry.get_next_filters(filters, response.next)
+  return dials_retry.merge_pages(response, results)
@@ -0,0 +1,192 @@
+#!/usr/bin/env python3
+
+
+# Local on-disk cache for DIALS responses
+# - The cache is content-addressed: each entry is stored in a file
+#   named after a hash of the request parameters
+#   (e.g. the workspace, the type of request and the filters).
+# - The total size of the cache is bounded: when it is exceeded,
+#   the least recently used entries are removed.
+#   The cache directory is only scanned when a running estimate of its size
+#   (from the first scan and the entries written since) exceeds the bound.
+# - Entries can be marked as volatile (e.g. for runs that might still be open,
+#   or for the list of runs in a dataset), in which case they expire after a given time.
+#
+# Usage example (e.g. in a notebook):
+#   sys.path.append('../datasets')
+#   import dials_cache
+#   dials_cache.configure(enabled=True, namespace='tracker')
+#   data = dials_cache.cached_call(['h2d', filters], lambda: dials.h2d.list_all(filters))
+
+
+# general imports
+import os
+import json
+import time
+import pickle
+import hashlib
+import tempfile
+import threading
+
+
+# default cache settings
+# note: these can be modified with configure()
+config = {
+  'enabled': False,
+  'cachedir': os.path.join(os.path.expanduser('~'), '.cache', 'dialstools'),
+  'maxsize': 5*1024**3, # in bytes
+  'ttl': 3600, # in seconds, only for volatile entries
+  'bypass': False,
+  'namespace': None
+}
+
+# running estimate of the total cache size
+# note: the estimate is only updated by this process (with the entries it writes),
+#       and is reset to the actual size at each scan of the cache directory (see evict).
+sizeestimate = {'cachedir': None, 'size': None}
+sizelock = threading.Lock()
+
+
+def configure(enabled=None, cachedir=None, maxsize=None, ttl=None, bypass=None, namespace=None):
+  ### set the cache settings
+  # input arguments:
+  # - enabled: whether to use the cache at all.
+  # - cachedir: directory to store the cache entries in.
+  # - maxsize: maximum total size of the cache (in bytes).
+  # - ttl: time (in seconds) after which volatile entries expire.
+  # - bypass: do not read from the cache (but still write new results to it),
+  #   can be used to force a refresh of the cached entries.
+  # - namespace: additional identifier to include in all keys (e.g. the DIALS workspace).
+  # note: arguments that are None are left at their current value.
+  if enabled is not None: config['enabled'] = enabled
+  if cachedir is not None: config['cachedir'] = cachedir
+  if maxsize is not None: config['maxsize'] = maxsize
+  if ttl is not None: config['ttl'] = ttl
+  if bypass is not None: config['bypass'] = bypass
+  if namespace is not None: config['namespace'] = namespace
+
+def serialize(obj):
+  ### helper function for make_key, converting DIALS filters to a json-serializable form
+  if hasattr(obj, 'model_dump'): fields = obj.model_dump()
+  elif hasattr(obj, 'dict'): fields = obj.dict()
+  else: fields = vars(obj)
+  return {'type': type(obj).__name__, 'fields': fields}
+
+def make_key(*parts):
+  ### make a cache key from a set of request parameters
+  # the parts can be any json-serializable objects or DIALS filters.
+  parts = [config['namespace']] + list(parts)
+  keystr = json.dumps(parts, sort_keys=True, default=serialize)
+  return hashlib.sha256(keystr.encode('utf-8')).hexdigest()
+
+def get_path(key):
+  ### get the path to the file for a given key
+  # note: entries are distributed over subdirectories
+  #       to avoid very large directories.
+  return os.path.join(config['cachedir'], key[:2], key+'.pkl')
+
+def get(key):
+  ### read an entry from the cache
+  # returns:
+  # a tuple (found, value), where found is False if the entry does not exist
+  # or is expired (in which case value is None).
+  path = get_path(key)
+  try:
+    with open(path, 'rb') as f:
+      entry = pickle.load(f)
+  except (FileNotFoundError, EOFError, pickle.UnpicklingError):
+    return (False, None)
+  if( entry['volatile'] and time.time()-entry['created']>config['ttl'] ):
+    return (False, None)
+  # update the modification time, which is used as access time for eviction
+  try: os.utime(path)
+  except FileNotFoundError: pass
+  return (True, entry['value'])
+
+def put(key, value, volatile=False):
+  ### write an entry to the cache
+  # note: the entry is first written to a temporary file and then renamed,
+  #       so that concurrent readers never see incomplete entries.
+  path = get_path(key)
+  os.makedirs(os.path.dirname(path), exist_ok=True)
+  entry = {'created': time.time(), 'volatile': volatile, 'value': value}
+  (fd, tmppath) = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+  with os.fdopen(fd, 'wb') as f:
+    pickle.dump(entry, f, protocol=pickle.HIGHEST_PROTOCOL)
+  size = os.path.getsize(tmppath)
+  try: size -= os.path.getsize(path)
+  except FileNotFoundError: pass
+  os.replace(tmppath, path)
+  # update the size estimate, and only scan the cache directory if it is exceeded
+  # (or if there is no estimate yet for this cache directory)
+  with sizelock:
+    known = (sizeestimate['cachedir']==config['cachedir'] and sizeestimate['size'] is not None)
+    if known: sizeestimate['size'] += size
+    if( known and sizeestimate['size']<=config['maxsize'] ): return
+  # note: when evicting, go somewhat below the maximum size,
+  #       so that the next writes do not immediately trigger a new scan.
+  evict(target=0.9*config['maxsize'])
+
+def evict(maxsize=None, target=None):
+  ### if the cache size is above maxsize, remove the least recently used entries
+  # until it is below target (default: maxsize)
+  # note: this scans the full cache directory, and updates the size estimate (see put).
+  if maxsize is None: maxsize = config['maxsize']
+  if target is None: target = maxsize
+  entries = []
+  totalsize = 0
+  if not os.path.exists(config['cachedir']):
+    set_sizeestimate(0)
+    return
+  for subdir in os.scandir(config['cachedir']):
+    if not subdir.is_dir(): continue
+    for entry in os.scandir(subdir.path):
+      if not entry.name.endswith('.pkl'): continue
+      try: stat = entry.stat()
+      except FileNotFoundError: continue
+      entries.append((stat.st_mtime, stat.st_size, entry.path))
+      totalsize += stat.st_size
+  if totalsize>maxsize:
+    for (_, size, path) in sorted(entries):
+      try: os.remove(path)
+      except FileNotFoundError: pass
+      totalsize -= size
+      if totalsize<=target: break
+  set_sizeestimate(totalsize)
+
+def set_sizeestimate(size):
+  ### set the estimate of the total cache size for the current cache directory
+  with sizelock:
+    sizeestimate['cachedir'] = config['cachedir']
+    sizeestimate['size'] = size
+
+def clear():
+  ### remove all entries from the cache
+  evict(maxsize=0)
+
+def cached_call(keyparts, func, volatile=False):
+  ### return the result of func(), using the cache if possible
+  # input arguments:
+  # - keyparts: list of request parameters identifying the result (see make_key).
+  # - func: function without arguments that makes the actual request.
+  # - volatile: whether the result might still change (see configure for the ttl).
+  if not config['enabled']: return func()
+  key = make_key(*keyparts)
+  if not config['bypass']:
+    (found, value) = get(key)
+    if found: return value
+  value = func()
+  put(key, value, volatile=volatile)
+  return value
+
+async def cached_call_async(keyparts, func, volatile=False):
+  ### same as cached_call, but for a coroutine function func (see dials_async.py)
+  # note: the cache files themselves are read and written synchronously.
+  if not config['enabled']: return await func()
+  key = make_key(*keyparts)
+  if not config['bypass']:
+    (found, value) = get(key)
+    if found: return value
+  value = await func()
+  put(key, value, volatile=volatile)
+  return value
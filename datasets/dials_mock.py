@@ -0,0 +1,270 @@
+#!/usr/bin/env python3
+
+
+# In-process mock of the DIALS API, for testing and benchmarking without network access
+# - Provides a stand-in for the Dials object of the cmsdials api,
+#   with the endpoints used in get_data_dials.py
+#   (run, dataset_index, h1d and h2d with list and list_all, and mes with a non-paginated list),
+#   returning synthetic data with the same structure as the real api.
+# - The responses are paginated (with a configurable page size, and a next_token cursor as in DIALS),
+#   and the latency per page and the rate of transient errors are configurable,
+#   as well as the datasets, runs, lumisections and the MEs with their histogram shapes.
+#
+# Usage example:
+#   import get_data_dials as gdd
+#   import dials_mock
+#   gdd.dials = dials_mock.MockDials(latency=0.05, page_size=100)
+#   df = gdd.get_run_data('h2d', '/ZeroBias/Run2024A-PromptReco-v1/DQMIO', 'PixelPhase1/.*', 380000)
+# note: filters are read through their attributes (e.g. dataset__regex, run_number__gte),
+#       so the filter classes of the cmsdials api can be used as usual.
+# see also benchmark_dials.py.
+
+
+# general imports
+import re
+import time
+import copy
+import random
+import threading
+import numpy as np
+import pandas as pd
+from types import SimpleNamespace
+from urllib.parse import urlparse
+from urllib.parse import parse_qs
+from urllib.parse import urlencode
+
+
+# default mock settings
+default_datasets = ['/ZeroBias/Run2024A-PromptReco-v1/DQMIO']
+default_mes = {
+  'PixelPhase1/Mock/h1_charge': 100,
+  'PixelPhase1/Mock/h2_occupancy': (72, 56)
+}
+
+
+class MockPage(object):
+  ### a single page of a paginated response
+  # (with the same attributes as the paginated responses of the cmsdials api)
+
+  def __init__(self, next=None, previous=None, results=None):
+    self.next = next
+    self.previous = previous
+    self.results = results if results is not None else []
+
+  def to_pandas(self):
+    return pd.DataFrame([vars(el) for el in self.results])
+
+
+class MockClient(object):
+  ### mock of a paginated cmsdials api client (e.g. dials.h2d)
+
+  def __init__(self, server, kind):
+    self.server = server
+    self.kind = kind
+
+  def list(self, filters):
+    ### get a single page of results
+    return self.server.get_page(self.kind, filters)
+
+  def list_all(self, filters, max_pages=None, enable_progress=False):
+    ### get all pages of results (up to max_pages)
+    results = []
+    page_filters = filters
+    npages = 0
+    while True:
+      response = self.server.get_page(self.kind, page_filters)
+      results += response.results
+      npages += 1
+      if response.next is None: break
+      if( max_pages is not None and npages>=max_pages ): break
+      page_filters = copy.copy(filters)
+      for key, values in parse_qs(urlparse(response.next).query).items():
+        setattr(page_filters, key, values[0])
+    return MockPage(next=response.next, results=results)
+
+
+class MockNonPaginatedClient(object):
+  ### mock of a non-paginated cmsdials api client (i.e. dials.mes)
+
+  def __init__(self, server, kind):
+    self.server = server
+    self.kind = kind
+
+  def list(self, filters=None):
+    ### get all results as a plain list
+    return self.server.get_rows(self.kind, filters)
+
+
+class MockDials(object):
+  ### mock of the Dials object of the cmsdials api
+
+  def __init__(self, datasets=None, runs=None, lumis=(100, 500), mes=None,
+               latency=0., latency_jitter=0., page_size=500, error_rate=0., seed=1):
+    ### initializer
+    # input arguments:
+    # - datasets: list of dataset names.
+    # - runs: list of run numbers (the same for each dataset), default: 10 runs.
+    # - lumis: number of lumisections per run, either a fixed number
+    #   or a tuple (min, max) for a random number per run.
+    # - mes: dict mapping ME names to their number of bins
+    #   (an int for 1D MEs, a tuple (nx, ny) for 2D MEs).
+    # - latency: time (in seconds) to respond to each page request.
+    # - latency_jitter: additional random time (uniform, in seconds) for each page request.
+    # - page_size: maximum number of results per page.
+    # - error_rate: probability of a transient error (ConnectionError) for each page request.
+    # - seed: seed for the random numbers (histogram contents, run lengths and errors).
+    self.datasets = datasets if datasets is not None else default_datasets
+    self.runs = runs if runs is not None else list(range(380000, 380010))
+    self.me_shapes = mes if mes is not None else default_mes
+    self.latency = latency
+    self.latency_jitter = latency_jitter
+    self.page_size = page_size
+    self.error_rate = error_rate
+    self.seed = seed
+    self.random = random.Random(seed)
+    self.lock = threading.Lock()
+    self.nrequests = 0
+    self.keycache = {}
+    self.histograms = {}
+    self.lscounts = {}
+    for run in self.runs:
+      if isinstance(lumis, int): self.lscounts[run] = lumis
+      else: self.lscounts[run] = self.random.randint(lumis[0], lumis[1])
+    self.run = MockClient(self, 'run')
+    self.dataset_index = MockClient(self, 'dataset_index')
+    self.mes = MockNonPaginatedClient(self, 'mes')
+    self.h1d = MockClient(self, 'h1d')
+    self.h2d = MockClient(self, 'h2d')
+
+  def get_medim(self, me):
+    ### get the dimension of an ME
+    return 1 if isinstance(self.me_shapes[me], int) else 2
+
+  def match(self, filters, field, value):
+    ### check whether a value passes the (exact or regex) filter for a given field
+    exact = getattr(filters, field, None)
+    if exact is not None: return (value==exact)
+    regex = getattr(filters, field+'__regex', None)
+    if regex is not None: return (re.search(regex, value) is not None)
+    return True
+
+  def match_run(self, filters, run):
+    ### check whether a run passes the run number filters
+    if getattr(filters, 'run_number', None) is not None and run!=filters.run_number: return False
+    if getattr(filters, 'run_number__gte', None) is not None and run<filters.run_number__gte: return False
+    if getattr(filters, 'run_number__lte', None) is not None and run>filters.run_number__lte: return False
+    return True
+
+  def make_histogram(self, me, run, ls):
+    ### get the (deterministic) histogram for a given ME, run and lumisection
+    # returns a tuple of the histogram contents (as nested lists) and the number of entries.
+    # note: the histograms are taken from a pool of histograms per ME that is made only once,
+    #       so that the time to respond to a request is dominated by the configured latency
+    #       rather than by the mock itself; only the (nested) list containers are copied
+    #       for each result, so that the results do not share mutable data.
+    if me not in self.histograms:
+      shape = self.me_shapes[me]
+      shape = (shape,) if isinstance(shape, int) else (shape[1], shape[0])
+      rng = np.random.default_rng([self.seed, sum([ord(c) for c in me])])
+      pool = rng.poisson(10, size=(64,)+shape).astype(float)
+      self.histograms[me] = [(hist.tolist(), int(np.sum(hist))) for hist in pool]
+    pool = self.histograms[me]
+    (hist, entries) = pool[(run*31+ls)%len(pool)]
+    if self.get_medim(me)==1: return (list(hist), entries)
+    return ([list(row) for row in hist], entries)
+
+  def get_filterkey(self, kind, filters):
+    ### get a hashable key for a given endpoint and filters, ignoring the pagination parameters
+    if filters is None: fields = {}
+    elif hasattr(filters, 'model_dump'): fields = filters.model_dump()
+    else: fields = vars(filters)
+    fields = [(key, repr(val)) for key, val in fields.items()
+              if key not in ['next_token', 'page_size'] and val is not None]
+    return (kind, tuple(sorted(fields)))
+
+  def get_keys(self, kind, filters):
+    ### get the keys of all results for a given endpoint and filters
+    # (i.e. the parameters needed to make each result, see make_result)
+    # note: the results themselves are only made for the requested page,
+    #       to keep the overhead of the mock itself small;
+    #       the keys are cached per endpoint and filters, so that they are not
+    #       enumerated again for each page.
+    filterkey = self.get_filterkey(kind, filters)
+    if filterkey in self.keycache: return self.keycache[filterkey]
+    keys = self.make_keys(kind, filters)
+    self.keycache[filterkey] = keys
+    return keys
+
+  def make_keys(self, kind, filters):
+    ### enumerate the keys of all results for a given endpoint and filters (see get_keys)
+    keys = []
+    if kind=='mes':
+      for me_id, me in enumerate(sorted(self.me_shapes.keys())):
+        if self.match(filters, 'me', me): keys.append((me_id, me))
+      return keys
+    for dataset_id, dataset in enumerate(self.datasets):
+      if not self.match(filters, 'dataset', dataset): continue
+      if kind=='dataset_index':
+        keys.append((dataset_id, dataset))
+        continue
+      for run in self.runs:
+        if not self.match_run(filters, run): continue
+        if kind=='run':
+          keys.append((dataset_id, dataset, run))
+          continue
+        for me_id, me in enumerate(sorted(self.me_shapes.keys())):
+          if self.get_medim(me)!={'h1d': 1, 'h2d': 2}[kind]: continue
+          if not self.match(filters, 'me', me): continue
+          for ls in range(1, self.lscounts[run]+1):
+            keys.append((dataset_id, dataset, me_id, me, run, ls))
+    return keys
+
+  def make_result(self, kind, key):
+    ### make a single result for a given endpoint and key (see get_keys)
+    if kind=='mes':
+      (me_id, me) = key
+      return SimpleNamespace(me_id=me_id, me=me, count=1, dim=self.get_medim(me))
+    if kind=='dataset_index':
+      (dataset_id, dataset) = key
+      parts = dataset.split('/')
+      return SimpleNamespace(dataset_id=dataset_id, dataset=dataset, era=parts[2].split('-')[0],
+               data_tier=parts[3], primary_ds_name=parts[1], processed_ds_name=parts[2],
+               processing_version=1, last_modification_date=None)
+    if kind=='run':
+      (dataset_id, dataset, run) = key
+      return SimpleNamespace(dataset_id=dataset_id, dataset=dataset,
+               run_number=run, ls_count=self.lscounts[run], ls_completeness=1.)
+    (dataset_id, dataset, me_id, me, run, ls) = key
+    shape = self.me_shapes[me]
+    row = {'dataset': dataset, 'me': me, 'dataset_id': dataset_id, 'file_id': 0,
+           'run_number': run, 'ls_number': ls, 'me_id': me_id}
+    if kind=='h1d':
+      row.update({'x_min': 0., 'x_max': float(shape), 'x_bin': float(shape)})
+    else:
+      row.update({'x_min': 0., 'x_max': float(shape[0]), 'x_bin': float(shape[0]),
+                  'y_min': 0., 'y_max': float(shape[1]), 'y_bin': float(shape[1])})
+    (row['data'], row['entries']) = self.make_histogram(me, run, ls)
+    return SimpleNamespace(**row)
+
+  def get_rows(self, kind, filters):
+    ### get all results for a given endpoint and filters (without pagination)
+    return [self.make_result(kind, key) for key in self.get_keys(kind, filters)]
+
+  def get_page(self, kind, filters):
+    ### get a single page of results for a given endpoint and filters
+    # note: as in the DIALS api, the position of the page is given by the next_token
+    #       in the filters (i.e. an opaque cursor, taken from the url of the previous page).
+    with self.lock:
+      self.nrequests += 1
+      delay = self.latency + self.random.uniform(0, self.latency_jitter)
+      error = (self.random.random()<self.error_rate)
+    time.sleep(delay)
+    if error: raise ConnectionError('mock DIALS: transient error')
+    start = int(getattr(filters, 'next_token', None) or 0)
+    keys = self.get_keys(kind, filters)
+    results = [self.make_result(kind, key) for key in keys[start:start+self.page_size]]
+    nextpage = None
+    if start+self.page_size<len(keys):
+      query = {'next_token': str(start+self.page_size)}
+      nextpage = 'https://mock-dials/api/v1/{}/?{}'.format(kind, urlencode(query))
+    return MockPage(next=nextpage, results=results)
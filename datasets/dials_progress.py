@@ -0,0 +1,92 @@
+#!/usr/bin/env python3
+
+
+# Machine-readable progress stream for get_data_dials.py
+# - Progress events are written as json objects, one per line, to a progress file.
+# - Each event has at least the keys 'event' (the type of event)
+#   and 'time' (unix time stamp), the other keys depend on the type of event:
+#   - 'start': start of the job (datasets, MEs and options).
+#   - 'dataset': start of a dataset (dataset, index, total, runs).
+#   - 'me': start of an ME (dataset, me, metype, index, total, runs).
+#   - 'request': a completed DIALS request for a run or a chunk of runs
+#     (dataset, me, metype, runs, latency in seconds, pages, retries, rows, bytes);
+#     pages is zero if the response was read from the local cache.
+#   - 'run': a completed run (dataset, me, metype, run, index, total, rows, lumis, bytes).
+#   - 'write': output files written for an ME (dataset, me, metype, rows).
+#   - 'summary': end of the job, with the totals over all requests
+#     (runs, requests, rows, bytes, pages, retries, elapsed and fetch time in seconds,
+#     and the throughput in rows per second and MB per second).
+# - Rows are lumisection histograms (i.e. one row per lumisection and ME),
+#   and bytes is an estimate of the in-memory size of the retrieved data
+#   (see estimate_nbytes).
+# See summarize_progress.py for a simple summary of one or more progress files.
+
+
+# general imports
+import os
+import json
+import time
+import threading
+
+
+# progress settings and totals
+# note: the settings can be modified with configure()
+config = {
+  'progressfile': None
+}
+totals = {}
+lock = threading.Lock()
+
+
+def configure(progressfile=None):
+  ### set the progress file (None to disable the progress stream) and reset the totals
+  # note: events are appended to the progress file if it already exists
+  #       (e.g. for resubmitted jobs).
+  config['progressfile'] = progressfile
+  if( progressfile is not None and len(os.path.dirname(progressfile))>0 ):
+    os.makedirs(os.path.dirname(progressfile), exist_ok=True)
+  totals.clear()
+  totals.update({'starttime': time.time(), 'runs': 0, 'requests': 0,
+    'rows': 0, 'bytes': 0, 'pages': 0, 'retries': 0, 'fetchtime': 0.})
+
+def enabled():
+  ### return whether the progress stream is enabled
+  return config['progressfile'] is not None
+
+def estimate_nbytes(df):
+  ### estimate the in-memory size (in bytes) of a dataframe retrieved from DIALS
+  # the size of the histogram data is estimated from the number of bins
+  # (assuming 8 bytes per bin), since the nested lists in the data column
+  # are not taken into account by pandas.
+  if len(df)==0: return 0
+  nbytes = int(df.drop(columns=['data'], errors='ignore').memory_usage(index=False).sum())
+  if 'x_bin' in df.columns:
+    nbins = df['x_bin'].astype('int64')
+    if 'y_bin' in df.columns: nbins = nbins * df['y_bin'].astype('int64')
+    nbytes += 8*int(nbins.sum())
+  return nbytes
+
+def emit(event, **fields):
+  ### write an event to the progress file
+  # note: the totals are updated for 'request' and 'run' events.
+  if config['progressfile'] is None: return
+  record = {'event': event, 'time': time.time()}
+  record.update(fields)
+  with lock:
+    if event=='request':
+      totals['requests'] += 1
+      for key in ['rows', 'bytes', 'pages', 'retries']: totals[key] += fields.get(key, 0)
+      totals['fetchtime'] += fields.get('latency', 0.)
+    elif event=='run': totals['runs'] += 1
+    with open(config['progressfile'], 'a') as f:
+      f.write(json.dumps(record, default=str)+'\n')
+
+def summary():
+  ### write the summary event to the progress file
+  if config['progressfile'] is None: return
+  elapsed = time.time() - totals['starttime']
+  fields = {key: value for key, value in totals.items() if key!='starttime'}
+  fields['elapsed'] = elapsed
+  fields['rows_per_second'] = totals['rows']/elapsed if elapsed>0 else None
+  fields['mb_per_second'] = totals['bytes']/1024**2/elapsed if elapsed>0 else None
+  emit('summary', **fields)
@@ -0,0 +1,152 @@
+#!/usr/bin/env python3
+
+
+# Client-side rate limiting for DIALS requests
+# - The request rate is limited with a token bucket:
+#   each request consumes a token, and tokens are added at a fixed rate
+#   (with a maximum of one second worth of tokens, to allow short bursts).
+# - The number of concurrent requests is limited with a fixed number of slots.
+# - Both are coordinated between all processes (and threads) on the same node
+#   that use the same lock directory, through lock files (using fcntl.flock),
+#   so that e.g. multiple local jobs with multiple workers each
+#   share the same limits. The locks are released automatically
+#   when a process terminates, even if it crashes.
+# - When the server responds that it is overloaded (see throttle),
+#   the rate is halved, after which it recovers gradually to the configured rate.
+#
+# Usage example:
+#   dials_ratelimit.configure(rate=10, maxconcurrent=4)
+#   with dials_ratelimit.limit():
+#     data = dials.h2d.list(filters)
+# note: the lock directory should be on a local file system (not e.g. on AFS or EOS),
+#       since file locks are not reliable on network file systems.
+
+
+# general imports
+import os
+import json
+import time
+import fcntl
+import tempfile
+import contextlib
+
+
+# default rate limiting settings
+# note: these can be modified with configure()
+config = {
+  'rate': None, # maximum number of requests per second (None for no limit)
+  'maxconcurrent': None, # maximum number of concurrent requests (None for no limit)
+  'rampup': 0.1, # relative increase of the rate per second after throttling
+  'lockdir': os.path.join(tempfile.gettempdir(), 'dialstools-ratelimit-{}'.format(os.getuid())),
+  'pollinterval': 0.05 # in seconds, polling interval while waiting for a free slot
+}
+
+
+def configure(rate=None, maxconcurrent=None, lockdir=None):
+  ### set the rate limiting settings
+  # input arguments:
+  # - rate: maximum number of requests per second (None for no limit).
+  # - maxconcurrent: maximum number of concurrent requests (None for no limit).
+  # - lockdir: directory for the lock files (default: in the system temporary directory);
+  #   all processes using the same directory share the same limits.
+  if( rate is not None and rate<=0 ):
+    msg = 'ERROR: rate limit must be positive (found {}).'.format(rate)
+    raise Exception(msg)
+  if( maxconcurrent is not None and maxconcurrent<1 ):
+    msg = 'ERROR: maximum number of concurrent requests must be at least 1 (found {}).'.format(maxconcurrent)
+    raise Exception(msg)
+  config['rate'] = rate
+  config['maxconcurrent'] = maxconcurrent
+  if lockdir is not None: config['lockdir'] = lockdir
+
+@contextlib.contextmanager
+def locked_state(name):
+  ### open, lock and return the shared state stored in a lock file
+  # the state is a dict that can be modified in place,
+  # it is written back and unlocked at the end of the with-block.
+  os.makedirs(config['lockdir'], exist_ok=True)
+  path = os.path.join(config['lockdir'], name)
+  fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o600)
+  with os.fdopen(fd, 'r+') as f:
+    fcntl.flock(f, fcntl.LOCK_EX)
+    try:
+      content = f.read()
+      try: state = json.loads(content)
+      except ValueError: state = {}
+      yield state
+      f.seek(0)
+      f.truncate()
+      json.dump(state, f)
+      f.flush()
+    finally:
+      fcntl.flock(f, fcntl.LOCK_UN)
+
+def acquire_token():
+  ### wait until a token is available in the shared token bucket and consume it
+  # returns the time spent waiting (in seconds).
+  maxrate = config['rate']
+  if maxrate is None: return 0.
+  starttime = time.time()
+  while True:
+    with locked_state('bucket.json') as state:
+      now = time.time()
+      # refill the bucket and recover the rate after throttling
+      # (using the time since the last update)
+      rate = state.get('rate', maxrate)
+      tokens = state.get('tokens', max(1., maxrate))
+      elapsed = max(0., now - state.get('time', now))
+      rate = min(maxrate, rate * (1 + config['rampup'])**elapsed)
+      tokens = min(max(1., rate), tokens + elapsed*rate)
+      acquired = (tokens>=1)
+      if acquired: tokens -= 1
+      state['rate'] = rate
+      state['tokens'] = tokens
+      state['time'] = now
+    if acquired: return time.time() - starttime
+    time.sleep((1-tokens)/rate)
+
+def throttle():
+  ### halve the shared request rate
+  # (to be called when the server responds that it is overloaded)
+  maxrate = config['rate']
+  if maxrate is None: return
+  with locked_state('bucket.json') as state:
+    rate = state.get('rate', maxrate)
+    state['rate'] = max(rate/2., maxrate/100.)
+    state['tokens'] = min(state.get('tokens', 0.), 0.)
+    state['time'] = time.time()
+
+@contextlib.contextmanager
+def acquire_slot():
+  ### wait until one of the shared concurrency slots is free and hold it during the with-block
+  # note: each slot is a lock file, which is locked (non-blocking) by the request using it.
+  maxconcurrent = config['maxconcurrent']
+  if maxconcurrent is None:
+    yield
+    return
+  os.makedirs(config['lockdir'], exist_ok=True)
+  f = None
+  while f is None:
+    for idx in range(maxconcurrent):
+      path = os.path.join(config['lockdir'], 'slot_{}.lock'.format(idx))
+      candidate = open(path, 'a')
+      try:
+        fcntl.flock(candidate, fcntl.LOCK_EX | fcntl.LOCK_NB)
+      except BlockingIOError:
+        candidate.close()
+        continue
+      f = candidate
+      break
+    if f is None: time.sleep(config['pollinterval'])
+  try:
+    yield
+  finally:
+    fcntl.flock(f, fcntl.LOCK_UN)
+    f.close()
+
+@contextlib.contextmanager
+def limit():
+  ### wait for a free concurrency slot and a token, and hold the slot during the with-block
+  with acquire_slot():
+    acquire_token()
+    yield
@@ -0,0 +1,197 @@
+#!/usr/bin/env python3
+
+
+# Retry policy for DIALS requests
+# - Failed requests are retried after a jittered exponential backoff delay,
+#   so that many jobs that fail at the same time (e.g. when the server is overloaded)
+#   do not all retry at the same time again.
+# - Errors are classified as retryable (e.g. connection errors, timeouts,
+#   or HTTP status codes indicating an overloaded server) or fatal
+#   (e.g. authentication errors or invalid requests), the latter are raised immediately.
+# - Each failed attempt is logged (on stderr) with its timing.
+# - Paginated requests can be retried per page (see list_pages),
+#   instead of restarting the full list_all call.
+# - Each attempt goes through the client-side rate limiter (see dials_ratelimit.py),
+#   which is notified when the server responds that it is overloaded.
+
+
+# general imports
+import sys
+import copy
+import time
+import random
+from urllib.parse import urlparse
+from urllib.parse import parse_qs
+
+# local imports
+import dials_ratelimit
+
+
+# default retry settings
+# note: these can be modified with configure()
+config = {
+  'max_attempts': 5,
+  'base_delay': 1., # in seconds, delay scale for the first retry
+  'max_delay': 60., # in seconds, maximum delay scale
+  'multiplier': 2., # increase of the delay scale per attempt
+  'verbose': True
+}
+
+# HTTP status codes that are considered transient
+retryable_status_codes = [408, 425, 429, 500, 502, 503, 504]
+
+# HTTP status codes indicating that the request rate should be reduced
+throttle_status_codes = [429, 503]
+
+
+def configure(max_attempts=None, base_delay=None, max_delay=None, multiplier=None, verbose=None):
+  ### set the retry settings
+  # note: arguments that are None are left at their current value.
+  if max_attempts is not None: config['max_attempts'] = max_attempts
+  if base_delay is not None: config['base_delay'] = base_delay
+  if max_delay is not None: config['max_delay'] = max_delay
+  if multiplier is not None: config['multiplier'] = multiplier
+  if verbose is not None: config['verbose'] = verbose
+
+def get_status_code(exc):
+  ### get the HTTP status code corresponding to an exception (None if not applicable)
+  response = getattr(exc, 'response', None)
+  status_code = getattr(response, 'status_code', None)
+  if status_code is None: status_code = getattr(exc, 'status_code', None)
+  return status_code
+
+def is_retryable(exc):
+  ### classify an exception as retryable (True) or fatal (False)
+  # note: unknown exceptions are considered retryable,
+  #       except for a few types that indicate a programming error.
+  status_code = get_status_code(exc)
+  if status_code is not None: return (status_code in retryable_status_codes)
+  if isinstance(exc, (ConnectionError, TimeoutError)): return True
+  if isinstance(exc, (KeyboardInterrupt, SyntaxError, NameError, AttributeError, TypeError)): return False
+  return True
+
+def get_delay(attempt):
+  ### get the delay (in seconds) before the next attempt
+  # the delay is drawn uniformly between zero and an exponentially increasing scale
+  # (also known as "full jitter").
+  scale = config['base_delay'] * config['multiplier']**(attempt-1)
+  scale = min(scale, config['max_delay'])
+  return random.uniform(0, scale)
+
+def call_with_retry(func, description='request', max_attempts=None, stats=None):
+  ### call func() (a function without arguments) with retries
+  # returns the result of func().
+  # note: if the maximum number of attempts is reached,
+  #       or in case of a fatal error, the last error is raised.
+  # note: if stats is a dict, the number of retries is added to stats['retries'].
+  if max_attempts is None: max_attempts = config['max_attempts']
+  attempt = 0
+  while True:
+    attempt += 1
+    starttime = time.time()
+    try:
+      with dials_ratelimit.limit():
+        # note: the timing excludes the time spent waiting for the rate limiter
+        starttime = time.time()
+        result = func()
+    except Exception as exc:
+      delay = handle_failure(exc, description, attempt, max_attempts, time.time()-starttime, stats=stats)
+      if delay is None: raise
+      time.sleep(delay)
+      continue
+    handle_success(description, attempt, max_attempts, time.time()-starttime)
+    return result
+
+def handle_failure(exc, description, attempt, max_attempts, duration, stats=None):
+  ### handle a failed attempt of a request (see call_with_retry)
+  # the server is throttled if needed (see dials_ratelimit.py), and the failure is logged.
+  # returns:
+  # the delay (in seconds) before the next attempt,
+  # or None if the request should not be retried (in which case the error should be raised).
+  retryable = is_retryable(exc)
+  if get_status_code(exc) in throttle_status_codes: dials_ratelimit.throttle()
+  if( not retryable or attempt>=max_attempts ):
+    if config['verbose']:
+      msg = 'WARNING: {} failed (attempt {}/{}, {:.1f} s, {}): {!r}'.format(
+            description, attempt, max_attempts, duration,
+            'retryable' if retryable else 'fatal', exc)
+      sys.stderr.write(msg+'\n')
+      sys.stderr.flush()
+    return None
+  if stats is not None: stats['retries'] = stats.get('retries', 0) + 1
+  delay = get_delay(attempt)
+  if config['verbose']:
+    msg = 'WARNING: {} failed (attempt {}/{}, {:.1f} s): {!r}; retrying in {:.1f} s'.format(
+          description, attempt, max_attempts, duration, exc, delay)
+    sys.stderr.write(msg+'\n')
+    sys.stderr.flush()
+  return delay
+
+def handle_success(description, attempt, max_attempts, duration):
+  ### handle a successful attempt of a request (see call_with_retry)
+  # (only logged if it was preceded by failed attempts)
+  if( attempt>1 and config['verbose'] ):
+    msg = 'INFO: {} succeeded (attempt {}/{}, {:.1f} s)'.format(
+          description, attempt, max_attempts, duration)
+    sys.stderr.write(msg+'\n')
+    sys.stderr.flush()
+
+def describe(filters):
+  ### make a short description of DIALS filters for the log messages
+  if hasattr(filters, 'model_dump'): fields = filters.model_dump()
+  elif hasattr(filters, 'dict'): fields = filters.dict()
+  else: fields = vars(filters)
+  fields = ['{}={}'.format(key, value) for key, value in fields.items() if value is not None]
+  return '{}({})'.format(type(filters).__name__, ', '.join(fields))
+
+def get_next_filters(filters, nexturl):
+  ### get the filters for the next page of a paginated request
+  # input arguments:
+  # - filters: filters for the current page.
+  # - nexturl: url of the next page (the 'next' attribute of a paginated response).
+  # note: the pagination parameter (e.g. page number or cursor) is taken from the
+  #       query parameters in the url that differ from the current filters.
+  next_filters = copy.deepcopy(filters)
+  for key, values in parse_qs(urlparse(str(nexturl)).query).items():
+    if not hasattr(filters, key): continue
+    if str(getattr(filters, key))==values[0]: continue
+    setattr(next_filters, key, values[0])
+  return next_filters
+
+def merge_pages(response, results):
+  ### make a paginated response containing the results of all pages
+  # (equivalent to what the list_all function of the cmsdials api returns)
+  fields = {'next': None, 'previous': None, 'results': results}
+  if hasattr(response, 'model_copy'): return response.model_copy(update=fields)
+  if hasattr(response, 'copy'): return response.copy(update=fields)
+  return type(response)(**fields)
+
+def list_pages(client, filters, max_pages=None, description=None, max_attempts=None, stats=None):
+  ### retrieve all pages of a paginated request, with retries per page
+  # input arguments:
+  # - client: cmsdials api client (e.g. dials.h2d).
+  # - filters: cmsdials filters for the request.
+  # - max_pages: maximum number of pages to retrieve (default: all).
+  # - description: description of the request for the log messages.
+  # - max_attempts: maximum number of attempts per page.
+  # - stats: optional dict, to which the number of pages ('pages')
+  #   and retries ('retries') are added.
+  # returns:
+  # the same as client.list_all(filters, max_pages=max_pages).
+  # note: in case of failures, only the failing page is retried
+  #       (instead of the full list_all call).
+  if description is None: description = describe(filters)
+  results = []
+  page_filters = filters
+  npages = 0
+  while True:
+    pagedescription = '{} (page {})'.format(description, npages+1)
+    response = call_with_retry(lambda: client.list(page_filters),
+                 description=pagedescription, max_attempts=max_attempts, stats=stats)
+    results += response.results
+    npages += 1
+    if stats is not None: stats['pages'] = stats.get('pages', 0) + 1
+    if response.next is None: break
+    if( max_pages is not None and npages>=max_pages ): break
+    page_filters = get_next_filters(filters, response.next)
+  return merge_pages(response, results)
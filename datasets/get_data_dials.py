@@ -6,11 +6,22 @@
 
 # general imports
 import os
+import re
 import sys
+import glob
 import json
+import time
+import shutil
+import bisect
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.compute as pc
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
 import argparse
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
 
 # dials imports
 from cmsdials import Dials
@@ -18,67 +29,711 @@ from cmsdials.auth.bearer import Credentials
 from cmsdials.filters import LumisectionFilters
 from cmsdials.filters import LumisectionHistogram1DFilters
 from cmsdials.filters import LumisectionHistogram2DFilters
+from cmsdials.filters import MEFilters
 from cmsdials.filters import RunFilters
+# note: the dataset index is only available in recent versions of the cmsdials api
+#       (else the dataset names are resolved from the run list, see resolve_datasets).
+try: from cmsdials.filters import DatasetIndexFilters
+except ImportError: DatasetIndexFilters = None
 
 # local imports
 sys.path.append(os.path.abspath('../'))
 import jobsubmission.condortools as ct
+import dials_cache
+import dials_retry
+import dials_ratelimit
+import dials_progress
+import dials_async
 
 
-def get_creds(max_attempts=5):
+# metadata (run lists and ME and dataset names) resolved in advance
+# note: this can be filled with load_metadata(), in which case
+#       get_runs, resolve_datasets and resolve_mes use it instead of querying DIALS
+#       (e.g. to share the metadata between all jobs in a submission,
+#       see the option --sharemetadata of get_data_dials_loop.py).
+resolved_metadata = {'runs': {}, 'datasets': {}, 'mes': {}}
+
+
+def get_creds(max_attempts=None):
   ### get dials credentials
   # the credential retrieval is essentially just a call to
   # Credentials.from_creds_file() (from the cmsdials api),
-  # but wrapped in a while-try-except block,
+  # but wrapped in a retry loop with exponential backoff (see dials_retry.py),
   # to catch potential transient errors.
-  authenticated = False
-  auth_attempt_counter = 0
-  while (auth_attempt_counter<max_attempts and not authenticated):
-    auth_attempt_counter += 1
-    print('Retrieving cmsdials credentials from cache...')
-    try:
-      creds = Credentials.from_creds_file()
-      authenticated = True
-    except: continue
-  if not authenticated:
-    # try one more time to trigger the original error again
-    creds = Credentials.from_creds_file()
+  print('Retrieving cmsdials credentials from cache...')
+  creds = dials_retry.call_with_retry(Credentials.from_creds_file,
+            description='credential retrieval', max_attempts=max_attempts)
   sys.stdout.flush()
   sys.stderr.flush()
   return creds
 
-def get_data(filters, max_attempts=5, max_pages=None):
+def get_data(filters, max_attempts=None, max_pages=None, volatile=False, stats=None):
   ### get dials data
-  # the data retrieval is essentially just a call to
+  # the data retrieval is essentially the same as a call to
   # h2d.list_all (or similar for h1d, from the cmsdials api),
-  # but wrapped in a while-try-except block,
-  # to catch potential transient errors.
+  # but the pages are retrieved one by one with retries and exponential backoff
+  # (see dials_retry.py), to catch potential transient errors
+  # without restarting from the first page.
+  # note: if the local response cache is enabled (see dials_cache.py),
+  #       the result is read from (or written to) the cache;
+  #       volatile results (e.g. for runs that might still be open)
+  #       expire after the cache ttl.
+  # note: if stats is a dict, the number of pages and retries are added to it
+  #       (see dials_retry.list_pages).
   
-  # first define correct cmsdials api function
+  # first define correct cmsdials api client
   # based on the type of filters
-  if isinstance(filters, LumisectionHistogram1DFilters):
-    dialsfunc = dials.h1d.list_all
-  elif isinstance(filters, LumisectionHistogram2DFilters):
-    dialsfunc = dials.h2d.list_all
-  else:
-    msg = 'ERROR: unrecognized type of DIALS filters: {}'.format(type(filters))
-    raise Exception(msg)
+  dialsclient = get_client(filters)
+
   # make a wrapped call to cmsdials api
-  data_retrieved = False
-  attempt_counter = 0
-  while (attempt_counter<max_attempts and not data_retrieved):
-    attempt_counter += 1
-    try:
-      data = dialsfunc(filters, max_pages=max_pages, enable_progress=False)
-      data_retrieved = True
-    except: continue
-  if not data_retrieved:
-    # try one more time to trigger the original error
-    data = dialsfunc(filters, max_pages=max_pages, enable_progress=False)
+  def retrieve():
+    return dials_retry.list_pages(dialsclient, filters, max_pages=max_pages,
+             max_attempts=max_attempts, stats=stats)
+  data = dials_cache.cached_call(['get_data', filters, max_pages], retrieve, volatile=volatile)
   sys.stdout.flush()
   sys.stderr.flush()
   return data
 
+async def get_data_async(engine, filters, max_attempts=None, max_pages=None, volatile=False, stats=None):
+  ### get dials data with the asynchronous fetch engine
+  # same as get_data, but the pages are requested through a dials_async.Engine,
+  # so that many requests can be in flight at the same time (see dials_async.py).
+  # note: the result is cached under the same key as for get_data.
+  dialsclient = get_client(filters)
+  async def retrieve():
+    return await dials_async.list_pages(engine, dialsclient, filters, max_pages=max_pages,
+                   max_attempts=max_attempts, stats=stats)
+  data = await dials_cache.cached_call_async(['get_data', filters, max_pages], retrieve, volatile=volatile)
+  return data
+
+def get_client(filters):
+  ### get the cmsdials api client corresponding to the type of filters
+  if isinstance(filters, LumisectionHistogram1DFilters):
+    return dials.h1d
+  elif isinstance(filters, LumisectionHistogram2DFilters):
+    return dials.h2d
+  msg = 'ERROR: unrecognized type of DIALS filters: {}'.format(type(filters))
+  raise Exception(msg)
+
+def get_runinfo(dataset):
+  ### get the run information (one entry per run and matching dataset) for a dataset
+  # note: the run list is always volatile in the response cache,
+  #       since new runs can be added to a dataset at any time.
+  runfilters = RunFilters(dataset__regex=dataset)
+  return dials_cache.cached_call(['get_runs', runfilters],
+           lambda: dials_retry.list_pages(dials.run, runfilters),
+           volatile=True).results
+
+def get_runs(dataset):
+  ### get the runs in a dataset
+  # returns:
+  # a dict mapping the run numbers (sorted and unique) to their number of lumisections
+  # (None if not known).
+  # note: if the dataset is a regular expression matching multiple datasets,
+  #       the lumisections of a given run are summed over all matching datasets.
+  if dataset in resolved_metadata['runs']:
+    return {run: lscount for run, lscount in resolved_metadata['runs'][dataset]}
+  runinfo = get_runinfo(dataset)
+  lscounts = {}
+  for el in sorted(runinfo, key=lambda el: el.run_number):
+    lscount = getattr(el, 'ls_count', None)
+    if el.run_number not in lscounts: lscounts[el.run_number] = lscount
+    elif( lscounts[el.run_number] is not None and lscount is not None ):
+      lscounts[el.run_number] += lscount
+  return lscounts
+
+def resolve_datasets(dataset):
+  ### get the names of all datasets matching a dataset name
+  # (that may contain regex-style metacharacters)
+  # returns a sorted list of dataset names.
+  # note: the dataset index of DIALS is used if available in the installed cmsdials version,
+  #       else the dataset names are taken from the run list (see get_runinfo),
+  #       in which case datasets without any runs are not found.
+  if dataset in resolved_metadata['datasets']: return resolved_metadata['datasets'][dataset]
+  if( DatasetIndexFilters is None or not hasattr(dials, 'dataset_index') ):
+    return sorted(list(set([el.dataset for el in get_runinfo(dataset)])))
+  datasetfilters = DatasetIndexFilters(dataset__regex=dataset)
+  result = dials_cache.cached_call(['resolve_datasets', datasetfilters],
+             lambda: dials_retry.list_pages(dials.dataset_index, datasetfilters),
+             volatile=True).results
+  return sorted(list(set([el.dataset for el in result])))
+
+def resolve_mes(me):
+  ### get the names of all MEs matching an ME name
+  # (that may contain regex-style metacharacters)
+  # returns a dict mapping the ME names (sorted) to their dimension
+  # (1 for h1d, 2 for h2d, or None if not known).
+  # note: the ME list is not paginated in the cmsdials api
+  #       (the client only has a list function, returning a plain list).
+  if me in resolved_metadata['mes']: return resolved_metadata['mes'][me]
+  mefilters = MEFilters(me__regex=me)
+  result = dials_cache.cached_call(['resolve_mes', mefilters],
+             lambda: dials_retry.call_with_retry(lambda: dials.mes.list(mefilters),
+                       description=dials_retry.describe(mefilters)),
+             volatile=True)
+  medims = {}
+  for el in sorted(result, key=lambda el: el.me):
+    medims[el.me] = getattr(el, 'dim', None)
+  return medims
+
+def make_metadata(datasets, mes):
+  ### resolve the metadata for a list of datasets and MEs
+  # returns a dict with the following keys:
+  # - 'runs': dict mapping each dataset to its runs, as a list of [run, lscount] pairs
+  #   (see get_runs; a list is used since json keys can only be strings).
+  # - 'datasets': dict mapping each dataset to the matching dataset names (see resolve_datasets).
+  # - 'mes': dict mapping each ME to the matching ME names and their dimension (see resolve_mes).
+  result = {'runs': {}, 'datasets': {}, 'mes': {}}
+  for dataset in datasets:
+    result['runs'][dataset] = [[run, lscount] for run, lscount in get_runs(dataset).items()]
+    result['datasets'][dataset] = resolve_datasets(dataset)
+  for me in mes:
+    result['mes'][me] = resolve_mes(me)
+  return result
+
+def write_metadata(metadatafile, result):
+  ### write metadata (see make_metadata) to a json file
+  with open(metadatafile+'.tmp', 'w') as f:
+    json.dump(result, f)
+  os.replace(metadatafile+'.tmp', metadatafile)
+
+def load_metadata(metadatafile):
+  ### load metadata (see make_metadata) from a json file
+  # note: the loaded metadata is added to the module-level resolved_metadata dict,
+  #       so that it is used by get_runs, resolve_datasets and resolve_mes.
+  with open(metadatafile, 'r') as f:
+    result = json.load(f)
+  for key in resolved_metadata.keys(): resolved_metadata[key].update(result.get(key, {}))
+
+def get_metypes(me):
+  ### get the type(s) of the MEs matching an ME name
+  # (that may contain regex-style metacharacters)
+  # returns a list of ME types ('h1d' and/or 'h2d'), based on the dimension
+  # of the matching MEs according to DIALS (see resolve_mes).
+  # note: if the dimension of some of the MEs is not known,
+  #       both types are returned, i.e. both the h1d and h2d endpoints are queried
+  #       (each of which only returns data for MEs of its own type).
+  medims = resolve_mes(me)
+  dims = set(medims.values())
+  if None in dims: return ['h1d', 'h2d']
+  metypes = []
+  if 1 in dims: metypes.append('h1d')
+  if 2 in dims: metypes.append('h2d')
+  return metypes
+
+def escape_regex(name):
+  ### escape regex-style metacharacters in a dataset or ME name
+  # note: the output file naming convention removes the backslashes again,
+  #       so the escaped name maps to the same output file as the original one.
+  return re.sub(r'([.^$*+?{}\[\]\\|()])', r'\\\1', name)
+
+def make_run_chunks(runs, lscounts=None, lumis_per_request=None):
+  ### group consecutive runs into chunks to be retrieved with a single request
+  # input arguments:
+  # - runs: list of run numbers (sorted)
+  # - lscounts: dict mapping run numbers to their number of lumisections
+  #   (for all runs in the dataset, not only the ones in runs)
+  # - lumis_per_request: targeted number of lumisections per chunk
+  #   (a run is never split, so chunks can be larger if a single run exceeds the target);
+  #   if None, each run is put in a separate chunk.
+  # returns:
+  # a list of lists of run numbers
+  # note: since a chunk is retrieved with a run range request,
+  #       a new chunk is started after each gap, i.e. if a run in lscounts
+  #       lies between two consecutive runs (e.g. a run that is already in a checkpoint
+  #       or in the existing output), so that it is not retrieved again.
+  if( lumis_per_request is None or lscounts is None ): return [[run] for run in runs]
+  allruns = sorted(lscounts.keys())
+  chunks = []
+  chunk = []
+  nlumis = 0
+  for run in runs:
+    # note: runs with unknown number of lumisections are put in a separate chunk
+    lscount = lscounts.get(run, None)
+    if lscount is None: lscount = lumis_per_request
+    gap = ( len(chunk)>0 and bisect.bisect_right(allruns, chunk[-1])<bisect.bisect_left(allruns, run) )
+    if( len(chunk)>0 and (gap or nlumis+lscount>lumis_per_request) ):
+      chunks.append(chunk)
+      chunk = []
+      nlumis = 0
+    chunk.append(run)
+    nlumis += lscount
+  if len(chunk)>0: chunks.append(chunk)
+  return chunks
+
+def make_filters(metype, dataset, me, runs):
+  ### make dials filters for a given dataset, ME and run(s)
+  # runs can be a single run number or a list of run numbers;
+  # in the latter case, a run range from the first to the last run is used.
+  runkwargs = {'run_number': runs}
+  if isinstance(runs, list):
+    if len(runs)==1: runkwargs = {'run_number': runs[0]}
+    else: runkwargs = {'run_number__gte': min(runs), 'run_number__lte': max(runs)}
+  if metype=='h1d':
+    dialsfilters = LumisectionHistogram1DFilters(
+      dataset__regex = dataset,
+      me__regex = me,
+      **runkwargs
+    )
+  elif metype=='h2d':
+    dialsfilters = LumisectionHistogram2DFilters(
+      dataset__regex = dataset,
+      me__regex = me,
+      **runkwargs
+    )
+  else:
+    msg = 'ERROR: metype {} not recognized'.format(metype)
+    raise Exception(msg)
+  return dialsfilters
+
+def get_run_data(metype, dataset, me, runs, max_pages=None, volatile=False, stats=None):
+  ### get dials data for a run (or a chunk of runs) and convert it to a dataframe
+  # note: if stats is a dict, the time it took (in seconds) is stored in stats['latency'],
+  #       and the number of pages and retries are added to it (see get_data).
+  starttime = time.time()
+  dialsfilters = make_filters(metype, dataset, me, runs)
+  data = get_data(dialsfilters, max_pages=max_pages, volatile=volatile, stats=stats)
+  df = data.to_pandas()
+  if stats is not None: stats['latency'] = time.time() - starttime
+  return df
+
+async def get_run_data_async(engine, metype, dataset, me, runs, max_pages=None, volatile=False, stats=None):
+  ### same as get_run_data, but with the asynchronous fetch engine (see get_data_async)
+  starttime = time.time()
+  dialsfilters = make_filters(metype, dataset, me, runs)
+  data = await get_data_async(engine, dialsfilters, max_pages=max_pages, volatile=volatile, stats=stats)
+  df = await engine.run(data.to_pandas)
+  if stats is not None: stats['latency'] = time.time() - starttime
+  return df
+
+def split_runs(df, runs):
+  ### split a dataframe for a chunk of runs into one dataframe per run
+  # returns a list of dataframes, one for each run in runs (in the same order).
+  # note: runs in the dataframe that are not in the provided list
+  #       (e.g. runs inside the run range that were not requested) are discarded.
+  if len(runs)==1: return [df]
+  if len(df)==0: return [df]*len(runs)
+  groups = {run: dfrun for run, dfrun in df.groupby('run_number', sort=False)}
+  return [groups[run].reset_index(drop=True) if run in groups else df.iloc[0:0] for run in runs]
+
+def report_progress(metype, dataset, me, chunk, df, stats, runidx, nruns):
+  ### write the progress events for a completed request (see dials_progress.py)
+  # and yield the dataframe for each run in it
+  # note: also prints the run progress (used by check_jobstatus.py).
+  if dials_progress.enabled():
+    dials_progress.emit('request', dataset=dataset, me=me, metype=metype, runs=chunk,
+      latency=stats.get('latency', 0.), pages=stats.get('pages', 0), retries=stats.get('retries', 0),
+      rows=len(df), bytes=dials_progress.estimate_nbytes(df))
+  for run, dfrun in zip(chunk, split_runs(df, chunk)):
+    runidx += 1
+    print('  - Run {} ({}/{})'.format(run, runidx, nruns))
+    sys.stdout.flush()
+    sys.stderr.flush()
+    if dials_progress.enabled():
+      nlumis = int(dfrun['ls_number'].nunique()) if len(dfrun)>0 else 0
+      dials_progress.emit('run', dataset=dataset, me=me, metype=metype, run=run,
+        index=runidx, total=nruns, rows=len(dfrun), lumis=nlumis,
+        bytes=dials_progress.estimate_nbytes(dfrun))
+    yield (run, dfrun)
+
+def iter_runs_data(metype, dataset, me, runs, workers=1, max_pages=None,
+                   lscounts=None, lumis_per_request=None, openruns=None, engine=None):
+  ### iterate over the dataframes for a list of runs
+  # yields tuples of the form (run, dataframe), in the same order as runs.
+  # if lumis_per_request is specified, consecutive runs are grouped into chunks
+  # (see make_run_chunks) that are retrieved with a single run range request,
+  # and the result is split again per run.
+  # if workers > 1, the requests for multiple runs (or chunks) are made concurrently
+  # in a thread pool; the number of requests that are in flight (or finished
+  # but not yet consumed) is bounded to a small multiple of workers,
+  # in order to keep the memory usage under control.
+  # if engine is a dials_async.Engine, the requests are made with the asynchronous
+  # fetch engine instead (and workers is ignored); in that case the number of requests
+  # that are in flight (or finished but not yet consumed) is bounded to a small multiple
+  # of the maximum number of in-flight page requests of the engine.
+  # note: retries are handled per page inside get_data.
+  # note: openruns is an optional collection of runs that might still be open,
+  #       the corresponding requests are marked as volatile in the response cache.
+  chunks = make_run_chunks(runs, lscounts=lscounts, lumis_per_request=lumis_per_request)
+  if openruns is None: openruns = []
+  volatiles = [any([run in openruns for run in chunk]) for chunk in chunks]
+  runidx = 0
+  if( workers<=1 and engine is None ):
+    for chunk, volatile in zip(chunks, volatiles):
+      stats = {}
+      df = get_run_data(metype, dataset, me, chunk, max_pages=max_pages, volatile=volatile, stats=stats)
+      yield from report_progress(metype, dataset, me, chunk, df, stats, runidx, len(runs))
+      runidx += len(chunk)
+    return
+  if engine is not None:
+    window = 2*engine.inflight
+    def submit(chunk, volatile, stats):
+      return engine.submit(get_run_data_async(engine, metype, dataset, me, chunk,
+               max_pages=max_pages, volatile=volatile, stats=stats))
+  else:
+    window = 2*workers
+    executor = ThreadPoolExecutor(max_workers=workers)
+    def submit(chunk, volatile, stats):
+      return executor.submit(get_run_data, metype, dataset, me, chunk,
+               max_pages=max_pages, volatile=volatile, stats=stats)
+  futures = deque()
+  nsubmitted = 0
+  try:
+    for chunkidx in range(len(chunks)):
+      # keep the submission window filled
+      while( len(futures)<window and nsubmitted<len(chunks) ):
+        chunk = chunks[nsubmitted]
+        stats = {}
+        futures.append((chunk, stats, submit(chunk, volatiles[nsubmitted], stats)))
+        nsubmitted += 1
+      # wait for the oldest chunk (to preserve the ordering)
+      chunk, stats, future = futures.popleft()
+      df = future.result()
+      yield from report_progress(metype, dataset, me, chunk, df, stats, runidx, len(runs))
+      runidx += len(chunk)
+  finally:
+    # cancel pending requests in case of errors
+    if engine is not None:
+      for _, _, future in futures: future.cancel()
+    else: executor.shutdown(wait=True, cancel_futures=True)
+
+def get_outputfile(outputdir, dataset, me):
+  ### get the conventional output file name for a given dataset and ME
+  outputfile = (dataset+'-'+me).strip('/').replace('/','-')+'.parquet'
+  outputfile = outputfile.replace('\\','')
+  outputfile = os.path.join(outputdir, outputfile)
+  return outputfile
+
+def make_tensor_table(df, dtype='float32'):
+  ### convert a dataframe to a pyarrow table with a dense tensor encoding of the histograms
+  # the 'data' column is converted from nested lists to a fixed-size list column
+  # (with the flattened bin contents of each histogram, in the given numpy dtype),
+  # and the binning columns (x_min, x_max, x_bin and similar for y)
+  # are removed and stored once in the schema metadata (under the key 'dialstools'),
+  # together with the histogram shape.
+  # note: all histograms in the dataframe must have the same binning.
+  # see also read_tensor_parquet in utils/dataframe_utils.py for the inverse operation.
+  bincolumns = [c for c in ['x_min', 'x_max', 'x_bin', 'y_min', 'y_max', 'y_bin'] if c in df.columns]
+  meta = {}
+  for column in bincolumns:
+    values = df[column].unique()
+    if len(values)!=1:
+      msg = 'ERROR: found multiple values for {} ({}),'.format(column, values)
+      msg += ' which is not supported for the tensor data format.'
+      raise Exception(msg)
+    meta[column] = values[0].item()
+  # flatten the (nested) lists of bin contents, checking that all histograms have the same shape
+  # note: this is done on the arrow representation to avoid a per-row conversion
+  values = pa.array(df['data'], from_pandas=True)
+  shape = []
+  while pa.types.is_list(values.type) or pa.types.is_large_list(values.type):
+    lengths = pc.list_value_length(values)
+    minmax = pc.min_max(lengths).as_py()
+    if( values.null_count>0 or minmax['min']!=minmax['max'] ):
+      msg = 'ERROR: found histograms with different shapes (or missing histograms),'
+      msg += ' which is not supported for the tensor data format.'
+      raise Exception(msg)
+    shape.append(minmax['min'])
+    values = values.flatten()
+  hists = values.to_numpy(zero_copy_only=False).astype(dtype)
+  meta['shape'] = shape
+  meta['dtype'] = dtype
+  nbins = int(np.prod(shape))
+  data = pa.FixedSizeListArray.from_arrays(pa.array(hists), nbins)
+  table = pa.Table.from_pandas(df.drop(columns=bincolumns+['data']), preserve_index=False)
+  table = table.append_column('data', data)
+  metadata = dict(table.schema.metadata)
+  metadata[b'dialstools'] = json.dumps(meta).encode('utf-8')
+  table = table.replace_schema_metadata(metadata)
+  return table
+
+def write_streaming(writers, df, outputdir, tensordtype=None):
+  ### append the rows of a dataframe to the corresponding output files
+  # input arguments:
+  # - writers: dict mapping output file names to pyarrow ParquetWriter objects;
+  #   new writers are created and added to it when needed.
+  # - df: dataframe (typically for a single run), may contain multiple datasets and/or MEs.
+  # - outputdir: directory to store the output files into.
+  # - tensordtype: if specified, use the tensor data format with this dtype
+  #   (see make_tensor_table); if None, the histograms are stored as nested lists.
+  # note: each call appends one row group per (dataset, ME) to the output files,
+  #       so the memory usage is bounded by the size of df.
+  # note: the data is written to temporary files, which are only moved
+  #       to their final name in close_writers (so that incomplete files
+  #       are never mistaken for finished ones, e.g. when using --resubmit).
+  if len(df)==0: return
+  for (datasetname, mename), dfpart in df.groupby(['dataset', 'me'], sort=False):
+    outputfile = get_outputfile(outputdir, datasetname, mename)
+    if tensordtype is not None: table = make_tensor_table(dfpart, dtype=tensordtype)
+    if outputfile not in writers:
+      if tensordtype is None: table = pa.Table.from_pandas(dfpart, preserve_index=False)
+      writers[outputfile] = pq.ParquetWriter(outputfile+'.tmp', table.schema)
+    elif tensordtype is None:
+      table = pa.Table.from_pandas(dfpart, schema=writers[outputfile].schema, preserve_index=False)
+    else:
+      if table.schema.metadata[b'dialstools']!=writers[outputfile].schema.metadata[b'dialstools']:
+        msg = 'ERROR: found histograms with different binning or shape for {},'.format(outputfile)
+        msg += ' which is not supported for the tensor data format.'
+        raise Exception(msg)
+      table = table.cast(writers[outputfile].schema)
+    writers[outputfile].write_table(table)
+
+def close_writers(writers):
+  ### close the writers made by write_streaming and move the files to their final name
+  for outputfile, writer in writers.items():
+    writer.close()
+    os.replace(outputfile+'.tmp', outputfile)
+
+def write_partitions(df, outputdir, tensordtype=None, workers=1):
+  ### split a dataframe per dataset and ME and write each part to its output file
+  # input arguments:
+  # - df: dataframe, may contain multiple datasets and/or MEs.
+  # - outputdir: directory to store the output files into.
+  # - tensordtype: see write_streaming.
+  # - workers: number of output files to write in parallel.
+  # note: the split is done in a single pass over the dataframe (using groupby),
+  #       and each part is written as soon as it is available,
+  #       so the time scales linearly with the number of rows.
+  # note: in parallel mode, at most workers parts are submitted at the same time,
+  #       so that the parts are not all copied out of the dataframe up front.
+  def write_partition(partition):
+    (datasetname, mename), dfpart = partition
+    outputfile = get_outputfile(outputdir, datasetname, mename)
+    if tensordtype is None: dfpart.to_parquet(outputfile+'.tmp', index=False)
+    else:
+      table = make_tensor_table(dfpart, dtype=tensordtype)
+      pq.write_table(table, outputfile+'.tmp')
+    os.replace(outputfile+'.tmp', outputfile)
+  partitions = df.groupby(['dataset', 'me'], sort=False)
+  if workers<=1:
+    for partition in partitions: write_partition(partition)
+    return
+  with ThreadPoolExecutor(max_workers=workers) as executor:
+    futures = deque()
+    for partition in partitions:
+      # note: wait for the oldest part before submitting a new one if the window is full,
+      #       and consume the results to propagate potential exceptions
+      if len(futures)>=workers: futures.popleft().result()
+      futures.append(executor.submit(write_partition, partition))
+    while len(futures)>0: futures.popleft().result()
+
+def get_hive_partitioning():
+  ### get the partitioning scheme of the hive output layout (see write_hive)
+  return ds.partitioning(pa.schema([
+    ('workspace', pa.string()),
+    ('dataset', pa.string()),
+    ('me', pa.string()),
+    ('run_number', pa.int64())]), flavor='hive')
+
+def write_hive(df, outputdir, workspace, tensordtype=None):
+  ### write the rows of a dataframe to a hive-partitioned parquet dataset
+  # the layout of the dataset is as follows:
+  # <outputdir>/workspace=<workspace>/dataset=<dataset>/me=<me>/run_number=<run>/part-0.parquet
+  # input arguments:
+  # - df: dataframe (typically for a single run), may contain multiple datasets and/or MEs.
+  # - outputdir: root directory of the partitioned dataset.
+  # - workspace: DIALS workspace (added as a partitioning column).
+  # - tensordtype: see write_streaming.
+  # note: the partition values are url-encoded in the directory names (e.g. '/' becomes '%2F');
+  #       see read_partitioned_parquet in utils/dataframe_utils.py for reading.
+  # note: existing partitions for the same run are overwritten, so rerunning is safe.
+  if len(df)==0: return
+  df = df.assign(workspace=workspace)
+  partitioning = get_hive_partitioning()
+  for (datasetname, mename), dfpart in df.groupby(['dataset', 'me'], sort=False):
+    if tensordtype is None: table = pa.Table.from_pandas(dfpart, preserve_index=False)
+    else: table = make_tensor_table(dfpart, dtype=tensordtype)
+    ds.write_dataset(table, outputdir, format='parquet', partitioning=partitioning,
+      basename_template='part-{i}.parquet', existing_data_behavior='delete_matching')
+
+def open_hive(outputdir):
+  ### open the partitioned dataset written by write_hive
+  # returns a pyarrow dataset, or None if there are no partitions yet.
+  # note: only the files in the workspace=* partitions are included,
+  #       so that other files below the root directory (e.g. run chunks of other jobs)
+  #       are never read as part of the dataset.
+  files = glob.glob(os.path.join(glob.escape(outputdir), 'workspace=*', '**', '*.parquet'), recursive=True)
+  if len(files)==0: return None
+  return ds.dataset(sorted(files), format='parquet', partitioning=get_hive_partitioning(),
+           partition_base_dir=outputdir)
+
+def get_coverage(outputdir, datasets, mes, layout='flat', workspace=None):
+  ### get the runs and lumisections that are already present in the output
+  # input arguments:
+  # - outputdir: output directory (or root directory of the partitioned dataset for hive layout).
+  # - datasets: list of dataset names (without regex-style metacharacters).
+  # - mes: list of ME names (without regex-style metacharacters).
+  # - layout: output layout ('flat' or 'hive'); for 'hive', the workspace is needed as well.
+  # returns:
+  # a dict mapping each (dataset, ME) pair to a dict mapping run numbers
+  # to their number of lumisections present in the output
+  # (the latter dict is empty if there is no output yet for a given pair).
+  coverage = {(dataset, me): {} for dataset in datasets for me in mes}
+  if layout=='hive':
+    dataset = open_hive(outputdir)
+    if dataset is None: return coverage
+    selection = ( (ds.field('workspace')==workspace)
+                  & ds.field('dataset').isin(datasets) & ds.field('me').isin(mes) )
+    df = dataset.to_table(columns=['dataset', 'me', 'run_number', 'ls_number'], filter=selection).to_pandas()
+  else:
+    dfs = []
+    for (datasetname, mename) in coverage.keys():
+      outputfile = get_outputfile(outputdir, datasetname, mename)
+      if not os.path.exists(outputfile): continue
+      dfs.append(pd.read_parquet(outputfile, columns=['dataset', 'me', 'run_number', 'ls_number']))
+    if len(dfs)==0: return coverage
+    df = pd.concat(dfs, ignore_index=True)
+  for (datasetname, mename, run), nls in df.groupby(['dataset', 'me', 'run_number'], sort=True).size().items():
+    if (datasetname, mename) not in coverage: continue
+    coverage[(datasetname, mename)][int(run)] = int(nls)
+  return coverage
+
+def merge_incremental(inputfile, outputfile):
+  ### merge a file with newly retrieved runs into an existing output file
+  # rows in the existing file for runs that are present in the new file are replaced,
+  # all other rows are kept; the new rows are appended after them.
+  # note: the files are copied row group by row group,
+  #       so the memory usage is bounded by the size of a single row group.
+  # note: the output is first written to a temporary file and then renamed;
+  #       the input file is removed afterwards.
+  # note: only the columns present in both files are kept (matched by name),
+  #       e.g. to drop the pandas index column of existing files written without index=False.
+  if not os.path.exists(outputfile):
+    os.replace(inputfile, outputfile)
+    return
+  newfile = pq.ParquetFile(inputfile)
+  oldfile = pq.ParquetFile(outputfile)
+  newmeta = newfile.schema_arrow.metadata or {}
+  oldmeta = oldfile.schema_arrow.metadata or {}
+  if newmeta.get(b'dialstools')!=oldmeta.get(b'dialstools'):
+    msg = 'ERROR: data format (or binning) of new data does not match existing file {}.'.format(outputfile)
+    raise Exception(msg)
+  columns = [name for name in oldfile.schema_arrow.names if name in newfile.schema_arrow.names]
+  schema = pa.schema([oldfile.schema_arrow.field(name) for name in columns], metadata=oldmeta)
+  if len(columns)<len(oldfile.schema_arrow.names):
+    # the pandas metadata refers to the dropped columns (e.g. the index)
+    schema = schema.remove_metadata().with_metadata({key: val for key, val in oldmeta.items() if key!=b'pandas'})
+  newruns = pq.read_table(inputfile, columns=['run_number'])['run_number'].unique()
+  writer = pq.ParquetWriter(outputfile+'.tmp', schema)
+  for idx in range(oldfile.num_row_groups):
+    table = oldfile.read_row_group(idx, columns=columns).cast(schema)
+    table = table.filter(pc.invert(pc.is_in(table['run_number'], value_set=newruns)))
+    if table.num_rows>0: writer.write_table(table)
+  for idx in range(newfile.num_row_groups):
+    writer.write_table(newfile.read_row_group(idx, columns=columns).cast(schema))
+  writer.close()
+  os.replace(outputfile+'.tmp', outputfile)
+  os.remove(inputfile)
+
+def get_workdir(outputdir, layout='flat'):
+  ### get the directory for intermediate files (checkpoints and newly retrieved data in incremental mode)
+  # note: for the flat layout, this is the output directory itself
+  #       (the intermediate files are in subdirectories, next to the output files);
+  #       for the hive layout, it is a sibling directory <outputdir>.work,
+  #       so that the root of the partitioned dataset only contains the partitions.
+  if layout=='hive': return os.path.normpath(outputdir)+'.work'
+  return outputdir
+
+def remove_empty_workdirs(path, outputdir, layout='flat'):
+  ### remove the parent directories of an intermediate directory or file that are left empty
+  # (e.g. <outputdir>/checkpoints after the last checkpoint directory was removed),
+  # up to the work directory (see get_workdir).
+  # note: the output directory itself is never removed.
+  workdir = os.path.abspath(get_workdir(outputdir, layout=layout))
+  outputdir = os.path.abspath(outputdir)
+  path = os.path.dirname(os.path.abspath(path))
+  while( path!=outputdir and (path==workdir or path.startswith(workdir+os.sep)) ):
+    if( not os.path.isdir(path) or len(os.listdir(path))>0 ): break
+    os.rmdir(path)
+    path = os.path.dirname(path)
+
+def fsync_path(path):
+  ### flush a file or directory to disk
+  # (for a directory, this makes e.g. the renaming of a file in it durable)
+  fd = os.open(path, os.O_RDONLY)
+  try: os.fsync(fd)
+  finally: os.close(fd)
+
+def get_incrementaldir(outputdir, dataset, me, layout='flat'):
+  ### get the directory for newly retrieved data in incremental mode
+  # for a given dataset and ME (as provided on input)
+  incrementaldir = get_outputfile(os.path.join(get_workdir(outputdir, layout=layout), 'incremental'), dataset, me)
+  incrementaldir = os.path.splitext(incrementaldir)[0]
+  return incrementaldir
+
+def get_checkpointdir(outputdir, dataset, me, metype=None, layout='flat'):
+  ### get the checkpoint directory for a given dataset and ME (as provided on input)
+  # note: if metype is specified, it is added to the name of the directory
+  #       (needed if the same ME name is retrieved for multiple ME types).
+  # note: the checkpoint directory is in the work directory (see get_workdir).
+  checkpointdir = get_outputfile(os.path.join(get_workdir(outputdir, layout=layout), 'checkpoints'), dataset, me)
+  checkpointdir = os.path.splitext(checkpointdir)[0]
+  if metype is not None: checkpointdir += '-'+metype
+  return checkpointdir
+
+def load_manifest(checkpointdir):
+  ### load the manifest of a checkpoint directory
+  # the manifest is a dict with (among others) the key 'runs',
+  # mapping each completed run (in string format) to its number of rows.
+  # if the checkpoint directory does not exist yet, an empty manifest is returned.
+  manifestfile = os.path.join(checkpointdir, 'manifest.json')
+  if not os.path.exists(manifestfile): return {'runs': {}}
+  with open(manifestfile, 'r') as f:
+    manifest = json.load(f)
+  return manifest
+
+def write_manifest(checkpointdir, manifest):
+  ### write the manifest of a checkpoint directory
+  # note: the manifest is first written to a temporary file and then renamed,
+  #       so that an interrupted job never leaves a corrupt manifest behind.
+  manifestfile = os.path.join(checkpointdir, 'manifest.json')
+  with open(manifestfile+'.tmp', 'w') as f:
+    json.dump(manifest, f)
+    f.flush()
+    os.fsync(f.fileno())
+  os.replace(manifestfile+'.tmp', manifestfile)
+
+def write_checkpoint(checkpointdir, manifest, run, df):
+  ### store the data for a completed run in a checkpoint directory
+  # the dataframe is written to a per-run part file,
+  # and the run is marked as completed in the manifest.
+  # note: the part file (and its directory entry) is flushed to disk
+  #       before the manifest is updated, so that a run in the manifest
+  #       always has a complete part file, even after a crash of the machine.
+  if not os.path.exists(checkpointdir): os.makedirs(checkpointdir)
+  if len(df)>0:
+    partfile = os.path.join(checkpointdir, 'run_{}.parquet'.format(run))
+    df.to_parquet(partfile+'.tmp', index=False)
+    fsync_path(partfile+'.tmp')
+    os.replace(partfile+'.tmp', partfile)
+    fsync_path(checkpointdir)
+  manifest['runs'][str(run)] = len(df)
+  write_manifest(checkpointdir, manifest)
+
+def finalize_checkpoint(checkpointdir, manifest, outputdir, tensordtype=None,
+                        layout='flat', workspace=None):
+  ### merge the part files in a checkpoint directory into the conventional output files
+  # returns the total number of rows written.
+  # note: if layout is 'hive', the part files are written to a partitioned dataset
+  #       instead (see write_hive, for which the workspace argument is needed).
+  # note: the part files are processed one by one in order of run number,
+  #       so the memory usage is bounded by the size of a single run.
+  # note: the checkpoint directory is removed after the output files are complete.
+  if not os.path.exists(outputdir): os.makedirs(outputdir)
+  writers = {}
+  nrows = 0
+  for run in sorted([int(run) for run in manifest['runs'].keys()]):
+    if manifest['runs'][str(run)]==0: continue
+    partfile = os.path.join(checkpointdir, 'run_{}.parquet'.format(run))
+    df = pd.read_parquet(partfile)
+    if layout=='hive': write_hive(df, outputdir, workspace, tensordtype=tensordtype)
+    else: write_streaming(writers, df, outputdir, tensordtype=tensordtype)
+    nrows += len(df)
+  if nrows==0: return 0
+  close_writers(writers)
+  shutil.rmtree(checkpointdir)
+  return nrows
+
 
 if __name__=='__main__':
 
@@ -90,10 +745,10 @@ if __name__=='__main__':
   parser.add_argument('-m', '--menames', required=True,
     help='Path to a json file containing a list of monitoring elements,'
         +' may contain regex-style metacharacters or sets.')
-  parser.add_argument('-t', '--metype', required=True, choices=['h1d', 'h2d'],
-    help='Type of MEs (choose from "h1d" or "h2d"), needed for correct DIALS syntax.'
-        +' Note: --menames json files with mixed 1D and 2D MEs are not supported,'
-        +' they should be splitted and submitted separately.')
+  parser.add_argument('-t', '--metype', required=True, choices=['h1d', 'h2d', 'auto'],
+    help='Type of MEs (choose from "h1d", "h2d" or "auto"), needed for correct DIALS syntax.'
+        +' With "auto", the type of each ME is determined from DIALS,'
+        +' so that --menames json files with mixed 1D and 2D MEs can be retrieved in one go.')
   parser.add_argument('-w', '--workspace', default='tracker',
     help='DIALS-workspace, see https://github.com/cms-DQM/dials-py?tab=readme-ov-file#workspace')
   parser.add_argument('-o', '--outputdir', default='.',
@@ -106,6 +761,100 @@ if __name__=='__main__':
     help='Run directly in terminal ("local") or in HTCondor job ("condor").')
   parser.add_argument('--cmssw', default=None,
     help='Path to CMSSW installation for loading software environment in job.')
+  parser.add_argument('--workers', default=1, type=int,
+    help='Number of runs to retrieve concurrently (default: 1, i.e. one run at a time);'
+        +' also used as the number of output files to write in parallel.')
+  parser.add_argument('--engine', default='threads', choices=['threads', 'async'],
+    help='Fetch engine: "threads" (default) retrieves --workers runs concurrently in a thread pool,'
+        +' "async" schedules the pages of many requests at the same time in an asyncio event loop,'
+        +' with at most --inflight page requests in flight (see dials_async.py).'
+        +' Note: both only overlap the waiting for the server,'
+        +' the cmsdials api opens a new HTTP session for each page request.')
+  parser.add_argument('--inflight', default=32, type=int,
+    help='Maximum number of page requests in flight for --engine async (default: 32).')
+  parser.add_argument('--streaming', default=False, action='store_true',
+    help='Write the data of each run to the output file(s) as soon as it is retrieved,'
+        +' instead of keeping all runs in memory until the end'
+        +' (strongly reduces the memory usage for large datasets and/or 2D MEs).')
+  parser.add_argument('--checkpoint', default=False, action='store_true',
+    help='Store the data for each completed run in a checkpoint directory'
+        +' (<outputdir>/checkpoints, or <outputdir>.work/checkpoints for the hive layout),'
+        +' and skip runs that are already present there.'
+        +' A job that crashed can then be restarted (e.g. using --resubmit),'
+        +' and will only retrieve the missing runs before writing the output file(s).')
+  parser.add_argument('--lumisperrequest', default=None, type=int,
+    help='Group consecutive runs into a single DIALS request (using a run range),'
+        +' targeting approximately this number of lumisections per request'
+        +' (default: one request per run).')
+  parser.add_argument('--dataformat', default='list', choices=['list', 'tensor'],
+    help='Format for the histogram data in the output files:'
+        +' "list" (default) stores the histograms as nested lists (as retrieved from DIALS),'
+        +' "tensor" stores them as a dense fixed-size array column (see --tensordtype),'
+        +' with the binning stored once in the file metadata'
+        +' (see read_tensor_parquet in utils/dataframe_utils.py for reading).')
+  parser.add_argument('--tensordtype', default='float32',
+    choices=['float32', 'float64', 'int32', 'int64'],
+    help='Data type for the histograms in tensor data format (default: float32).')
+  parser.add_argument('--outputlayout', default='flat', choices=['flat', 'hive'],
+    help='Layout of the output: "flat" (default) writes one parquet file per dataset and ME,'
+        +' "hive" writes a partitioned parquet dataset with one directory level per'
+        +' workspace, dataset, ME and run (see read_partitioned_parquet'
+        +' in utils/dataframe_utils.py for reading).'
+        +' Note: the hive layout is always written run by run (as in --streaming),'
+        +' and --resubmit only applies to the flat layout.')
+  parser.add_argument('--incremental', default=False, action='store_true',
+    help='Retrieve only runs that are newer than the most recent run already present'
+        +' in the existing output (including that run itself, since it might have been'
+        +' still open at the time), and add them to the existing output.'
+        +' Note: cannot be combined with --resubmit.')
+  parser.add_argument('--firstrun', default=None, type=int,
+    help='Retrieve only runs with a run number larger than or equal to this one.')
+  parser.add_argument('--lastrun', default=None, type=int,
+    help='Retrieve only runs with a run number smaller than or equal to this one.')
+  parser.add_argument('--donefile', default=None,
+    help='Path to a file to create when the job finished successfully'
+        +' (used by get_data_dials_loop.py to mark completed run chunks, see merge_runchunks.py).')
+  parser.add_argument('--metadatafile', default=None,
+    help='Path to a json file with metadata (run lists and ME and dataset names)'
+        +' that were resolved in advance (e.g. by get_data_dials_loop.py with --sharemetadata);'
+        +' DIALS is only queried for datasets and MEs that are not in this file.')
+  parser.add_argument('--cache', default=False, action='store_true',
+    help='Use a local on-disk cache for DIALS responses,'
+        +' so that repeated requests (e.g. when rerunning) are read from disk.')
+  parser.add_argument('--cachedir', default=None,
+    help='Directory for the response cache (default: ~/.cache/dialstools).')
+  parser.add_argument('--cachemaxsize', default=5., type=float,
+    help='Maximum size of the response cache in GB (default: 5);'
+        +' the least recently used entries are removed when it is exceeded.')
+  parser.add_argument('--cachettl', default=3600, type=int,
+    help='Time in seconds after which cached responses expire'
+        +' for the run lists and for the most recent run of each dataset'
+        +' (which might still be open), default: 3600.')
+  parser.add_argument('--cachebypass', default=False, action='store_true',
+    help='Do not read from the response cache (but still write to it),'
+        +' e.g. to force a refresh of the cached responses.')
+  parser.add_argument('--maxattempts', default=5, type=int,
+    help='Maximum number of attempts for each DIALS request (default: 5);'
+        +' errors that are not transient (e.g. authentication errors) are not retried.')
+  parser.add_argument('--retrydelay', default=1., type=float,
+    help='Delay scale in seconds before the first retry of a failed DIALS request (default: 1);'
+        +' the delay scale is doubled for each further attempt, and the actual delay'
+        +' is drawn randomly between zero and the delay scale.')
+  parser.add_argument('--retrymaxdelay', default=60., type=float,
+    help='Maximum delay scale in seconds between retries (default: 60).')
+  parser.add_argument('--ratelimit', default=None, type=float,
+    help='Maximum number of DIALS requests per second (default: no limit),'
+        +' shared between all jobs and workers on the same machine (see dials_ratelimit.py).')
+  parser.add_argument('--maxconcurrent', default=None, type=int,
+    help='Maximum number of concurrent DIALS requests (default: no limit),'
+        +' shared between all jobs and workers on the same machine (see dials_ratelimit.py).')
+  parser.add_argument('--ratelimitdir', default=None,
+    help='Directory for the lock files of the rate limiter'
+        +' (default: in the system temporary directory, should be on a local file system).')
+  parser.add_argument('--progressfile', default=None,
+    help='Path to a file to write a machine-readable progress stream to'
+        +' (json lines with per-run timing and size information and a final summary,'
+        +' see dials_progress.py and summarize_progress.py).')
   parser.add_argument('--test', default=False, action='store_true',
     help='Truncate data for small and quick tests.')
   args = parser.parse_args()
@@ -115,13 +864,52 @@ if __name__=='__main__':
   for arg in vars(args):
     print('  - {}: {}'.format(arg,getattr(args,arg)))
 
+  # check arguments
+  if( args.incremental and args.resubmit ):
+    msg = 'ERROR: options --incremental and --resubmit cannot be used together.'
+    raise Exception(msg)
+  if( args.ratelimit is not None and args.ratelimit<=0 ):
+    msg = 'ERROR: option --ratelimit must be positive.'
+    raise Exception(msg)
+  if( args.maxconcurrent is not None and args.maxconcurrent<1 ):
+    msg = 'ERROR: option --maxconcurrent must be at least 1.'
+    raise Exception(msg)
+
   # handle job submission if requested
   if args.runmode=='condor':
     cmd = 'python3 get_data_dials.py'
     cmd += ' -d {}'.format(args.datasetnames)
     cmd += ' -m {}'.format(args.menames)
     cmd += ' -t {}'.format(args.metype)
+    cmd += ' -w {}'.format(args.workspace)
     cmd += ' -o {}'.format(args.outputdir)
+    cmd += ' --workers {}'.format(args.workers)
+    cmd += ' --engine {}'.format(args.engine)
+    cmd += ' --inflight {}'.format(args.inflight)
+    if args.streaming: cmd += ' --streaming'
+    if args.checkpoint: cmd += ' --checkpoint'
+    if args.lumisperrequest is not None: cmd += ' --lumisperrequest {}'.format(args.lumisperrequest)
+    cmd += ' --dataformat {}'.format(args.dataformat)
+    cmd += ' --tensordtype {}'.format(args.tensordtype)
+    cmd += ' --outputlayout {}'.format(args.outputlayout)
+    if args.firstrun is not None: cmd += ' --firstrun {}'.format(args.firstrun)
+    if args.lastrun is not None: cmd += ' --lastrun {}'.format(args.lastrun)
+    if args.incremental: cmd += ' --incremental'
+    if args.metadatafile is not None: cmd += ' --metadatafile {}'.format(args.metadatafile)
+    if args.donefile is not None: cmd += ' --donefile {}'.format(args.donefile)
+    if args.progressfile is not None: cmd += ' --progressfile {}'.format(args.progressfile)
+    if args.cache:
+      cmd += ' --cache'
+      if args.cachedir is not None: cmd += ' --cachedir {}'.format(args.cachedir)
+      cmd += ' --cachemaxsize {}'.format(args.cachemaxsize)
+      cmd += ' --cachettl {}'.format(args.cachettl)
+      if args.cachebypass: cmd += ' --cachebypass'
+    cmd += ' --maxattempts {}'.format(args.maxattempts)
+    cmd += ' --retrydelay {}'.format(args.retrydelay)
+    cmd += ' --retrymaxdelay {}'.format(args.retrymaxdelay)
+    if args.ratelimit is not None: cmd += ' --ratelimit {}'.format(args.ratelimit)
+    if args.maxconcurrent is not None: cmd += ' --maxconcurrent {}'.format(args.maxconcurrent)
+    if args.ratelimitdir is not None: cmd += ' --ratelimitdir {}'.format(args.ratelimitdir)
     if args.resubmit: cmd += ' --resubmit'
     if args.test: cmd += ' --test'
     cmd += ' --runmode local'
@@ -133,6 +921,9 @@ if __name__=='__main__':
   sys.stderr.write('###starting###\n')
   sys.stderr.flush()
 
+  # start the progress stream (if requested)
+  dials_progress.configure(progressfile=args.progressfile)
+
   # make a list of datasets
   datasets = []
   print('Reading {}...'.format(args.datasetnames))
@@ -149,12 +940,57 @@ if __name__=='__main__':
   print('Found following MEs:')
   for me in mes: print('  - {}'.format(me))
 
+  # parse data format
+  tensordtype = None
+  if args.dataformat=='tensor': tensordtype = args.tensordtype
+
+  # configure the retry policy
+  dials_retry.configure(max_attempts=args.maxattempts,
+    base_delay=args.retrydelay, max_delay=args.retrymaxdelay)
+
+  # configure the rate limiter
+  dials_ratelimit.configure(rate=args.ratelimit, maxconcurrent=args.maxconcurrent,
+    lockdir=args.ratelimitdir)
+
   # do authentication
   creds = get_creds()
 
   # create Dials object
   dials = Dials(creds, workspace=args.workspace)
 
+  # configure the response cache
+  dials_cache.configure(enabled=args.cache, cachedir=args.cachedir,
+    maxsize=int(args.cachemaxsize*1024**3), ttl=args.cachettl,
+    bypass=args.cachebypass, namespace=args.workspace)
+
+  # start the asynchronous fetch engine (if requested)
+  engine = None
+  if args.engine=='async': engine = dials_async.Engine(inflight=args.inflight)
+
+  # load metadata that was resolved in advance (if requested)
+  if args.metadatafile is not None:
+    print('Reading metadata from {}...'.format(args.metadatafile))
+    load_metadata(args.metadatafile)
+
+  # determine the type of each ME (if requested)
+  # note: an ME name with regex-style metacharacters can match MEs of both types,
+  #       in which case it is retrieved once for each type.
+  # note: if the type could not be determined, both types are tried,
+  #       and empty results are not considered an error.
+  metasks = [(me, args.metype) for me in mes]
+  probes = []
+  if args.metype=='auto':
+    print('Determining ME types...')
+    metasks = []
+    for me in mes:
+      metypes = get_metypes(me)
+      if len(metypes)==0: print('WARNING: no MEs found for {}'.format(me))
+      if None in resolve_mes(me).values(): probes += [(me, metype) for metype in metypes]
+      for metype in metypes: metasks.append((me, metype))
+    for me, metype in metasks: print('  - {}: {}'.format(me, metype))
+
+  dials_progress.emit('start', datasets=datasets, mes=mes, args=vars(args))
+
   # loop over datasets
   for datasetidx,dataset in enumerate(datasets):
     print('Now running on dataset {} ({}/{})'.format(dataset, datasetidx+1, len(datasets)))
@@ -162,18 +998,25 @@ if __name__=='__main__':
     sys.stderr.flush()
 
     # retrieve run numbers
-    # note: this is done to make separate calls per run 
+    # note: this is done to make separate calls per run (or chunk of runs)
     #       instead of one giant call for a full dataset
-    runfilters = RunFilters(dataset__regex=dataset)
-    runs = dials.run.list_all(runfilters, enable_progress=False).results
-    runs = sorted([el.run_number for el in runs])
+    lscounts = get_runs(dataset)
+    runs = list(lscounts.keys())
+    openruns = runs[-1:]
+    if args.firstrun is not None: runs = [run for run in runs if run>=args.firstrun]
+    if args.lastrun is not None: runs = [run for run in runs if run<=args.lastrun]
     print('Found {} runs'.format(len(runs)))
+    dials_progress.emit('dataset', dataset=dataset, index=datasetidx+1, total=len(datasets), runs=len(runs))
 
     # loop over mes
-    for meidx,me in enumerate(mes):
-      print('Now running on ME {} ({}/{})'.format(me, meidx+1, len(mes)))
+    # note: the run list is shared between all MEs (of both types)
+    for meidx,(me,metype) in enumerate(metasks):
+      print('Now running on ME {} ({}/{})'.format(me, meidx+1, len(metasks)))
+      if args.metype=='auto': print('ME type: {}'.format(metype))
       sys.stdout.flush()
       sys.stderr.flush()
+      dials_progress.emit('me', dataset=dataset, me=me, metype=metype,
+        index=meidx+1, total=len(metasks), runs=len(runs))
       dfs = []
 
       # check if output file already exists and if so, skip this part
@@ -186,66 +1029,126 @@ if __name__=='__main__':
           print('Output file {} already exists, skipping this part.'.format(outputfile))
           continue
 
+      # check which runs are already present in the output (if requested)
+      # note: the last run that is already present is retrieved again,
+      #       since it might have been still open at the time of the previous retrieval.
+      # note: in flat layout, the new data is first written to a separate directory
+      #       and then merged into the existing output files.
+      runs_todo = runs
+      outputdir = args.outputdir
+      if args.incremental:
+        medim = {'h1d': 1, 'h2d': 2}[metype]
+        menames = [name for name, dim in resolve_mes(me).items() if dim in [None, medim]]
+        coverage = get_coverage(args.outputdir, resolve_datasets(dataset), menames,
+                     layout=args.outputlayout, workspace=args.workspace)
+        lastruns = [max(runlist.keys()) if len(runlist)>0 else None for runlist in coverage.values()]
+        if( len(lastruns)>0 and None not in lastruns ):
+          runs_todo = [run for run in runs if run>=min(lastruns)]
+        nruns = sum([len(runlist) for runlist in coverage.values()])
+        nlumis = sum([sum(runlist.values()) for runlist in coverage.values()])
+        msg = 'Found existing output for {}/{} datasets and MEs'.format(
+                sum([len(runlist)>0 for runlist in coverage.values()]), len(coverage))
+        msg += ' ({} runs, {} lumisections),'.format(nruns, nlumis)
+        msg += ' will retrieve {} runs.'.format(len(runs_todo))
+        print(msg)
+        if len(runs_todo)==0: continue
+        if args.outputlayout=='flat':
+          outputdir = get_incrementaldir(args.outputdir, dataset, me, layout=args.outputlayout)
+          if os.path.exists(outputdir): shutil.rmtree(outputdir)
+
+      # check which runs were already retrieved before (if requested)
+      if args.checkpoint:
+        checkpointdir = get_checkpointdir(args.outputdir, dataset, me,
+                          metype=(metype if args.metype=='auto' else None), layout=args.outputlayout)
+        manifest = load_manifest(checkpointdir)
+        manifest['dataset'] = dataset
+        manifest['me'] = me
+        nruns = len(runs_todo)
+        runs_todo = [run for run in runs_todo if str(run) not in manifest['runs']]
+        if len(runs_todo)<nruns:
+          msg = 'Found checkpoint with {} completed runs,'.format(nruns-len(runs_todo))
+          msg += ' will retrieve only the remaining {} runs.'.format(len(runs_todo))
+          print(msg)
+
       # loop over runs
-      for runidx,run in enumerate(runs):
-        print('  - Run {} ({}/{})'.format(run, runidx+1, len(runs)))
-        sys.stdout.flush()
-        sys.stderr.flush()
-
-        # define filter
-        if args.metype=='h1d':
-          dialsfilters = LumisectionHistogram1DFilters(
-            dataset__regex = dataset,
-            me__regex = me,
-            run_number = run
-          )
-        elif args.metype=='h2d':
-          dialsfilters = LumisectionHistogram2DFilters(
-            dataset__regex = dataset,
-            me__regex = me,
-            run_number = run
-          )
-        else:
-          msg = 'ERROR: metype {} not recognized'.format(args.metype)
-          raise Exception(msg)
-        max_pages = None
-        if args.test: max_pages = 1
-
-        # make the dials request
-        data = get_data(dialsfilters, max_pages=max_pages)
-
-        # convert to dataframe
-        df = data.to_pandas()
-        dfs.append(df)
-
-      # concatenate results for all runs
-      df = pd.concat(dfs, ignore_index=True)
-
-      # check if the dataframe is empty
-      if len(df)==0:
-        msg = 'ERROR: resulting dataframe is empty, cannot write output file.'
+      # note: in streaming mode, the data for each run is directly
+      #       appended to the output file(s) instead of being kept in memory;
+      #       in hive layout, it is directly written to its own partition;
+      #       in checkpoint mode, it is stored in a per-run part file instead.
+      max_pages = None
+      if args.test: max_pages = 1
+      writers = {}
+      nrows = 0
+      streaming = (args.streaming or args.outputlayout=='hive')
+      if( streaming and not os.path.exists(outputdir) ): os.makedirs(outputdir)
+      for run, df in iter_runs_data(metype, dataset, me, runs_todo,
+                                    workers=args.workers, max_pages=max_pages,
+                                    lscounts=lscounts, lumis_per_request=args.lumisperrequest,
+                                    openruns=openruns, engine=engine):
+        if args.checkpoint:
+          write_checkpoint(checkpointdir, manifest, run, df)
+        elif args.outputlayout=='hive':
+          write_hive(df, outputdir, args.workspace, tensordtype=tensordtype)
+          nrows += len(df)
+        elif args.streaming:
+          write_streaming(writers, df, outputdir, tensordtype=tensordtype)
+          nrows += len(df)
+        else: dfs.append(df)
+
+      # finalize output files in checkpoint mode
+      if args.checkpoint:
+        print('Writing output file(s)...')
+        nrows = finalize_checkpoint(checkpointdir, manifest, outputdir,
+                  tensordtype=tensordtype, layout=args.outputlayout, workspace=args.workspace)
+        remove_empty_workdirs(checkpointdir, args.outputdir, layout=args.outputlayout)
+
+      # finalize output files in streaming mode
+      elif streaming:
+        if nrows>0: print('Writing output file(s)...')
+        close_writers(writers)
+
+      # write output files at once
+      # note: the dataframe can contain multiple datasets and/or MEs
+      #       (if the provided dataset/ME name is a regular expression),
+      #       in which case it is split into one output file per dataset and ME.
+      else:
+        df = pd.concat(dfs, ignore_index=True)
+        nrows = len(df)
+        if nrows>0:
+          print('Writing output file(s)...')
+          if not os.path.exists(outputdir): os.makedirs(outputdir)
+          write_partitions(df, outputdir, tensordtype=tensordtype, workers=args.workers)
+
+      # check if the data is empty
+      # note: in incremental mode, this is not an error
+      #       (e.g. if the new runs do not contain data for this ME yet),
+      #       and neither if the ME type could not be determined.
+      if nrows==0:
+        if( args.incremental or (me,metype) in probes ):
+          print('No new data found.')
+          continue
+        msg = 'ERROR: retrieved data is empty, cannot write output file.'
         raise Exception(msg)
+      dials_progress.emit('write', dataset=dataset, me=me, metype=metype, rows=nrows)
+
+      # merge the new data into the existing output files (in incremental mode)
+      if( args.incremental and args.outputlayout=='flat' ):
+        print('Merging new data into existing output file(s)...')
+        for inputfile in sorted(glob.glob(os.path.join(outputdir, '*.parquet'))):
+          merge_incremental(inputfile, os.path.join(args.outputdir, os.path.basename(inputfile)))
+        shutil.rmtree(outputdir)
+        remove_empty_workdirs(outputdir, args.outputdir, layout=args.outputlayout)
+
+  # stop the asynchronous fetch engine
+  if engine is not None: engine.close()
+
+  # write the summary of the progress stream
+  dials_progress.summary()
 
-      # check if the dataframe contains multiple datasets and/or MEs
-      # (can occur if the provided dataset/ME name is a regular expression),
-      # and if so, split into one dataframe per dataset and ME.
-      dfdict = {}
-      datasetnames = list(set(df['dataset']))
-      menames = list(set(df['me']))
-      for datasetname in datasetnames:
-        dfdict[datasetname] = {}
-        for mename in menames:
-          dfdict[datasetname][mename] = df[(df['me']==mename) & (df['dataset']==datasetname)]
-
-      # write to output file(s)
-      print('Writing output file(s)...')
-      if not os.path.exists(args.outputdir): os.makedirs(args.outputdir)
-      for datasetname in dfdict.keys():
-        for mename in dfdict[datasetname].keys():
-          outputfile = (datasetname+'-'+mename).strip('/').replace('/','-')+'.parquet'
-          outputfile = outputfile.replace('\\','')
-          outputfile = os.path.join(args.outputdir, outputfile)
-          dfdict[datasetname][mename].to_parquet(outputfile)
+  # mark the job as completed (if requested)
+  if args.donefile is not None:
+    if len(os.path.dirname(args.donefile))>0: os.makedirs(os.path.dirname(args.donefile), exist_ok=True)
+    with open(args.donefile, 'w') as f: pass
 
   # print finishing tag (for job completion checking)
   sys.stderr.write('###done###\n')
@@ -12,6 +12,25 @@ import argparse
 # local imports
 sys.path.append(os.path.abspath('../'))
 import jobsubmission.condortools as ct
+import jobsubmission.pooltools as pt
+
+
+def init_dials(workspace, max_attempts=None, base_delay=None, max_delay=None,
+               rate=None, maxconcurrent=None, lockdir=None):
+  ### initialize DIALS access for planning the jobs
+  # returns the get_data_dials module, with its global dials object set.
+  # the other arguments set the retry policy (see dials_retry.py)
+  # and the rate limits (see dials_ratelimit.py).
+  # note: the imports are done here, since DIALS access is only needed
+  #       for some of the options.
+  import get_data_dials as gdd
+  from cmsdials import Dials
+  gdd.dials_retry.configure(max_attempts=max_attempts,
+    base_delay=base_delay, max_delay=max_delay)
+  gdd.dials_ratelimit.configure(rate=rate, maxconcurrent=maxconcurrent, lockdir=lockdir)
+  creds = gdd.get_creds()
+  gdd.dials = Dials(creds, workspace=workspace)
+  return gdd
 
 
 if __name__=='__main__':
@@ -26,28 +45,108 @@ if __name__=='__main__':
     help='Path to a json file containing a list of monitoring elements.'
         +' Multiple files can be provided, in which case their contents are simply concatenated.'
         +' The monitoring element names may contain regex-style metacharacters or sets.')
-  parser.add_argument('-t', '--metype', required=True, choices=['h1d', 'h2d'],
-    help='Type of MEs (choose from "h1d" or "h2d"), needed for correct DIALS syntax.'
-        +' Note: --menames json files with mixed 1D and 2D MEs are not supported,'
-        +' they should be splitted and submitted separately.')
+  parser.add_argument('-t', '--metype', required=True, choices=['h1d', 'h2d', 'auto'],
+    help='Type of MEs (choose from "h1d", "h2d" or "auto"), needed for correct DIALS syntax.'
+        +' With "auto", the type of each ME is determined from DIALS,'
+        +' so that --menames json files with mixed 1D and 2D MEs can be retrieved in one go.')
   parser.add_argument('-w', '--workspace', default='tracker',
     help='DIALS-workspace, see https://github.com/cms-DQM/dials-py?tab=readme-ov-file#workspace')
   parser.add_argument('-o', '--outputdir', default='.',
     help='Directory to store output parquet files into.')
   parser.add_argument('--splitdatasets', default=False, action='store_true',
     help='Submit separate jobs for each dataset in the provided list.'
-        +' Note: lines with regex-expressions are kept in a single job.')
+        +' Note: lines with regex-expressions are kept in a single job,'
+        +' unless --expandregex is used.')
   parser.add_argument('--splitmes', default=False, action='store_true',
     help='Submit separate jobs for each monitoring element in the provided list'
-        +' Note: lines with regex-expressions are kept in a single job.')
+        +' Note: lines with regex-expressions are kept in a single job,'
+        +' unless --expandregex is used.')
+  parser.add_argument('--expandregex', default=False, action='store_true',
+    help='Resolve the regex-expressions in the dataset and monitoring element names'
+        +' against DIALS before splitting the jobs, so that --splitdatasets and --splitmes'
+        +' result in one job per concrete dataset and/or monitoring element.'
+        +' Note: requires valid DIALS credentials (see init_credentials.py).')
+  parser.add_argument('--runs-per-job', default=None, type=int,
+    help='Split the jobs further into chunks of this number of runs'
+        +' (per dataset file, i.e. per dataset if --splitdatasets is used).'
+        +' The output of each run chunk is stored in <outputdir>/runchunks,'
+        +' and should be merged afterwards using merge_runchunks.py'
+        +' (done automatically for local runmode).'
+        +' Note: requires valid DIALS credentials (see init_credentials.py).')
+  parser.add_argument('--sharemetadata', default=False, action='store_true',
+    help='Resolve the run lists and ME names (and types) once before submitting the jobs,'
+        +' and share them with all jobs through a json file,'
+        +' instead of querying them separately in each job.'
+        +' Note: requires valid DIALS credentials (see init_credentials.py).')
   parser.add_argument('--resubmit', default=False, action='store_true',
     help='Submit only jobs for output files that are not yet present in the output directory'
         +' (can be used if a small fraction of jobs failed because of transient errors).'
         +' Note: lines with regex-expressions will be resubmitted regardless.')
-  parser.add_argument('--runmode', default='local', choices=['local', 'condor'],
-    help='Run directly in terminal ("local") or in HTCondor job ("condor").')
+  parser.add_argument('--incremental', default=False, action='store_true',
+    help='Retrieve only runs that are newer than the most recent run already present'
+        +' in the output directory, and add them to the existing output files'
+        +' (see get_data_dials.py). Note: cannot be combined with --resubmit or --runs-per-job.')
+  parser.add_argument('--runmode', default='local', choices=['local', 'condor', 'pool'],
+    help='Run directly in terminal one job after the other ("local"),'
+        +' in HTCondor jobs ("condor"), or in parallel processes on the local machine ("pool",'
+        +' see --jobs).')
+  parser.add_argument('--jobs', default=None, type=int,
+    help='Number of jobs to run in parallel for --runmode pool'
+        +' (default: number of cores on the local machine).')
   parser.add_argument('--cmssw', default=None,
     help='Path to CMSSW installation for loading software environment in job.')
+  parser.add_argument('--workers', default=1, type=int,
+    help='Number of runs to retrieve concurrently within each job (default: 1).')
+  parser.add_argument('--engine', default='threads', choices=['threads', 'async'],
+    help='Fetch engine within each job, see get_data_dials.py.')
+  parser.add_argument('--inflight', default=32, type=int,
+    help='Maximum number of page requests in flight within each job for --engine async (default: 32).')
+  parser.add_argument('--streaming', default=False, action='store_true',
+    help='Write the data of each run to the output file(s) as soon as it is retrieved'
+        +' (strongly reduces the memory usage of each job).')
+  parser.add_argument('--checkpoint', default=False, action='store_true',
+    help='Store the data for each completed run in a checkpoint directory,'
+        +' so that resubmitted jobs only retrieve the runs that are still missing.')
+  parser.add_argument('--lumisperrequest', default=None, type=int,
+    help='Group consecutive runs into a single DIALS request,'
+        +' targeting approximately this number of lumisections per request.')
+  parser.add_argument('--dataformat', default='list', choices=['list', 'tensor'],
+    help='Format for the histogram data in the output files, see get_data_dials.py.')
+  parser.add_argument('--tensordtype', default='float32',
+    choices=['float32', 'float64', 'int32', 'int64'],
+    help='Data type for the histograms in tensor data format (default: float32).')
+  parser.add_argument('--outputlayout', default='flat', choices=['flat', 'hive'],
+    help='Layout of the output, see get_data_dials.py.')
+  parser.add_argument('--maxattempts', default=5, type=int,
+    help='Maximum number of attempts for each DIALS request (default: 5).')
+  parser.add_argument('--retrydelay', default=1., type=float,
+    help='Delay scale in seconds before the first retry of a failed DIALS request'
+        +' (default: 1, increasing exponentially for further attempts).')
+  parser.add_argument('--retrymaxdelay', default=60., type=float,
+    help='Maximum delay scale in seconds between retries (default: 60).')
+  parser.add_argument('--ratelimit', default=None, type=float,
+    help='Maximum number of DIALS requests per second (default: no limit),'
+        +' shared between all jobs and workers on the same machine.')
+  parser.add_argument('--maxconcurrent', default=None, type=int,
+    help='Maximum number of concurrent DIALS requests (default: no limit),'
+        +' shared between all jobs and workers on the same machine.')
+  parser.add_argument('--ratelimitdir', default=None,
+    help='Directory for the lock files of the rate limiter, see get_data_dials.py.')
+  parser.add_argument('--progressdir', default=None,
+    help='Directory to write a machine-readable progress file for each job into'
+        +' (named progress_<job index>.jsonl), see get_data_dials.py'
+        +' and summarize_progress.py.')
+  parser.add_argument('--cache', default=False, action='store_true',
+    help='Use a local on-disk cache for DIALS responses within each job, see get_data_dials.py.')
+  parser.add_argument('--cachedir', default=None,
+    help='Directory for the response cache (default: ~/.cache/dialstools).')
+  parser.add_argument('--cachemaxsize', default=5., type=float,
+    help='Maximum size of the response cache in GB (default: 5).')
+  parser.add_argument('--cachettl', default=3600, type=int,
+    help='Time in seconds after which volatile cached responses expire (default: 3600),'
+        +' see get_data_dials.py.')
+  parser.add_argument('--cachebypass', default=False, action='store_true',
+    help='Do not read from the response cache (but still write to it).')
   parser.add_argument('--test', default=False, action='store_true',
     help='Truncate loop and data for small and quick tests.')
   args = parser.parse_args()
@@ -57,6 +156,17 @@ if __name__=='__main__':
   for arg in vars(args):
     print('  - {}: {}'.format(arg,getattr(args,arg)))
 
+  # check arguments
+  if( args.incremental and (args.resubmit or args.runs_per_job is not None) ):
+    msg = 'ERROR: option --incremental cannot be combined with --resubmit or --runs-per-job.'
+    raise Exception(msg)
+  if( args.ratelimit is not None and args.ratelimit<=0 ):
+    msg = 'ERROR: option --ratelimit must be positive.'
+    raise Exception(msg)
+  if( args.maxconcurrent is not None and args.maxconcurrent<1 ):
+    msg = 'ERROR: option --maxconcurrent must be at least 1.'
+    raise Exception(msg)
+
   # check and parse CMSSW argument
   if args.cmssw is not None: args.cmssw = os.path.abspath(args.cmssw)
 
@@ -72,8 +182,60 @@ if __name__=='__main__':
     with open(this_menames, 'r') as f:
       menames += json.load(f)
 
+  # resolve regex-expressions in dataset and monitoring element names (if requested)
+  # note: the concrete names are escaped again (without changing the output file names),
+  #       since get_data_dials.py interprets them as regular expressions.
+  gdd = None
+  if( args.expandregex or args.runs_per_job is not None or args.sharemetadata ):
+    gdd = init_dials(args.workspace, max_attempts=args.maxattempts,
+            base_delay=args.retrydelay, max_delay=args.retrymaxdelay,
+            rate=args.ratelimit, maxconcurrent=args.maxconcurrent, lockdir=args.ratelimitdir)
+  if args.expandregex:
+    print('Resolving dataset names...')
+    expanded_datasets = []
+    for dataset in datasets:
+      this_datasets = gdd.resolve_datasets(dataset)
+      if len(this_datasets)==0: print('WARNING: no datasets found for {}'.format(dataset))
+      expanded_datasets += [gdd.escape_regex(el) for el in this_datasets]
+    datasets = sorted(list(set(expanded_datasets)))
+    print('Found {} datasets'.format(len(datasets)))
+    print('Resolving monitoring element names...')
+    # note: unless the ME type is "auto", only MEs of the requested type are kept
+    #       (as when the regex is passed to get_data_dials.py without expansion);
+    #       MEs of unknown type are kept as well.
+    expanded_menames = []
+    dropped_menames = set()
+    for mename in menames:
+      this_medims = gdd.resolve_mes(mename)
+      if len(this_medims)==0: print('WARNING: no monitoring elements found for {}'.format(mename))
+      this_menames = list(this_medims.keys())
+      if args.metype!='auto':
+        medim = {'h1d': 1, 'h2d': 2}[args.metype]
+        this_menames = [name for name in this_menames if this_medims[name] in [None, medim]]
+        dropped_menames.update([name for name in this_medims.keys() if name not in this_menames])
+      expanded_menames += [gdd.escape_regex(el) for el in this_menames]
+    menames = sorted(list(set(expanded_menames)))
+    print('Found {} monitoring elements'.format(len(menames)))
+    if len(dropped_menames)>0:
+      msg = 'Note: skipped {} monitoring elements that are not of type {}'.format(len(dropped_menames), args.metype)
+      print(msg)
+
+  # resolve metadata for all jobs (if requested)
+  # note: the metadata is also stored in the get_data_dials module,
+  #       so that it is reused below (e.g. for planning run chunks).
+  metadatafile = None
+  if args.sharemetadata:
+    print('Resolving run lists and monitoring element names...')
+    metadata = gdd.make_metadata(datasets, menames)
+    metadatafile = 'temp_metadata.json'
+    gdd.write_metadata(metadatafile, metadata)
+    gdd.resolved_metadata.update(metadata)
+    print('Written metadata to {}'.format(metadatafile))
+
   # handle splitting per dataset
-  datasetfiles = [args.datasetnames]
+  datasetfiles = ['temp_datasets.json']
+  with open(datasetfiles[0], 'w') as f:
+    json.dump(datasets, f)
   if args.splitdatasets:
     datasetfiles = []
     for i,dataset in enumerate(datasets):
@@ -83,7 +245,9 @@ if __name__=='__main__':
         json.dump([dataset], f)
 
   # handle splitting per monitoring element
-  mefiles = [args.menames]
+  mefiles = ['temp_menames.json']
+  with open(mefiles[0], 'w') as f:
+    json.dump(menames, f)
   if args.splitmes:
     mefiles = []
     for i,mename in enumerate(menames):
@@ -92,6 +256,24 @@ if __name__=='__main__':
       with open(mefile, 'w') as f:
         json.dump([mename], f)
 
+  # handle splitting per run chunk
+  # note: the run chunks are determined per dataset file,
+  #       based on the union of the runs in all of its datasets.
+  runchunks = {datasetfile: [None] for datasetfile in datasetfiles}
+  if args.runs_per_job is not None:
+    print('Planning run chunks...')
+    for datasetfile in datasetfiles:
+      with open(datasetfile, 'r') as f:
+        this_datasets = json.load(f)
+      runs = set()
+      for dataset in this_datasets: runs.update(gdd.get_runs(dataset).keys())
+      runs = sorted(list(runs))
+      runchunks[datasetfile] = []
+      for i in range(0, len(runs), args.runs_per_job):
+        chunk = runs[i:i+args.runs_per_job]
+        runchunks[datasetfile].append((chunk[0], chunk[-1]))
+      print('  - {}: {} runs in {} chunks'.format(datasetfile, len(runs), len(runchunks[datasetfile])))
+
   # make output directory
   if not os.path.exists(args.outputdir): os.makedirs(args.outputdir)
 
@@ -122,20 +304,72 @@ if __name__=='__main__':
     if not go=='y': sys.exit()
 
   # loop over datasets and monitoring elements
+  # note: in case of run chunks, each job creates a marker file in the done subdirectory
+  #       of its run chunk when it finished successfully, and the list of all expected
+  #       marker files is written to <outputdir>/runchunks/jobs.json (see merge_runchunks.py).
   cmds = []
+  chunkjobs = {}
   for datasetfile in datasetfiles:
     for mefile in mefiles:
+      jobname = '{}-{}'.format(os.path.splitext(os.path.basename(datasetfile))[0],
+                  os.path.splitext(os.path.basename(mefile))[0])
+      for runchunk in runchunks[datasetfile]:
+        if runchunk is None: continue
+        chunkname = '{}-{}'.format(*runchunk)
+        if chunkname not in chunkjobs: chunkjobs[chunkname] = []
+        chunkjobs[chunkname].append(jobname)
       if (datasetfile,mefile) in veto_jobs: continue
-      cmd = 'python3 get_data_dials.py'
-      cmd += ' -d {}'.format(datasetfile)
-      cmd += ' -m {}'.format(mefile)
-      cmd += ' -t {}'.format(args.metype)
-      cmd += ' -w {}'.format(args.workspace)
-      cmd += ' -o {}'.format(args.outputdir)
-      if args.resubmit: cmd += ' --resubmit'
-      if args.test: cmd += ' --test'
-      cmd += ' --runmode local'
-      cmds.append(cmd)
+      for runchunk in runchunks[datasetfile]:
+        outputdir = args.outputdir
+        donefile = None
+        if runchunk is not None:
+          outputdir = os.path.join(args.outputdir, 'runchunks', '{}-{}'.format(*runchunk))
+          donefile = os.path.join(outputdir, 'done', jobname)
+        cmd = 'python3 get_data_dials.py'
+        cmd += ' -d {}'.format(datasetfile)
+        cmd += ' -m {}'.format(mefile)
+        cmd += ' -t {}'.format(args.metype)
+        cmd += ' -w {}'.format(args.workspace)
+        cmd += ' -o {}'.format(outputdir)
+        cmd += ' --workers {}'.format(args.workers)
+        cmd += ' --engine {}'.format(args.engine)
+        cmd += ' --inflight {}'.format(args.inflight)
+        if args.streaming: cmd += ' --streaming'
+        if args.checkpoint: cmd += ' --checkpoint'
+        if args.lumisperrequest is not None: cmd += ' --lumisperrequest {}'.format(args.lumisperrequest)
+        cmd += ' --dataformat {}'.format(args.dataformat)
+        cmd += ' --tensordtype {}'.format(args.tensordtype)
+        cmd += ' --outputlayout {}'.format(args.outputlayout)
+        cmd += ' --maxattempts {}'.format(args.maxattempts)
+        cmd += ' --retrydelay {}'.format(args.retrydelay)
+        cmd += ' --retrymaxdelay {}'.format(args.retrymaxdelay)
+        if args.ratelimit is not None: cmd += ' --ratelimit {}'.format(args.ratelimit)
+        if args.maxconcurrent is not None: cmd += ' --maxconcurrent {}'.format(args.maxconcurrent)
+        if args.ratelimitdir is not None: cmd += ' --ratelimitdir {}'.format(args.ratelimitdir)
+        if args.cache:
+          cmd += ' --cache'
+          if args.cachedir is not None: cmd += ' --cachedir {}'.format(args.cachedir)
+          cmd += ' --cachemaxsize {}'.format(args.cachemaxsize)
+          cmd += ' --cachettl {}'.format(args.cachettl)
+          if args.cachebypass: cmd += ' --cachebypass'
+        if runchunk is not None: cmd += ' --firstrun {} --lastrun {}'.format(*runchunk)
+        if donefile is not None: cmd += ' --donefile {}'.format(donefile)
+        if metadatafile is not None: cmd += ' --metadatafile {}'.format(metadatafile)
+        if args.incremental: cmd += ' --incremental'
+        if args.progressdir is not None:
+          progressfile = os.path.join(args.progressdir, 'progress_{}.jsonl'.format(len(cmds)))
+          cmd += ' --progressfile {}'.format(progressfile)
+        if args.resubmit: cmd += ' --resubmit'
+        if args.test: cmd += ' --test'
+        cmd += ' --runmode local'
+        cmds.append(cmd)
+
+  # write the list of expected jobs per run chunk
+  if len(chunkjobs)>0:
+    jobsfile = os.path.join(args.outputdir, 'runchunks', 'jobs.json')
+    if not os.path.exists(os.path.dirname(jobsfile)): os.makedirs(os.path.dirname(jobsfile))
+    with open(jobsfile, 'w') as f:
+      json.dump(chunkjobs, f, indent=2)
 
   # limit for testing
   if args.test: cmds = [cmds[0]]
@@ -145,7 +379,39 @@ if __name__=='__main__':
     ct.submitCommandsAsCondorCluster('cjob_get_data', cmds,
       cmssw_version=args.cmssw, home='auto',
       jobflavour='workday')
+    if args.runs_per_job is not None:
+      msg = 'Note: when all jobs are finished, merge the run chunks using'
+      msg += ' python3 merge_runchunks.py -o {}'.format(args.outputdir)
+      print(msg)
+  elif args.runmode=='pool':
+    failed = pt.runCommandsInPool('cjob_get_data', cmds, jobs=args.jobs)
+    if len(failed)>0:
+      msg = 'Note: some jobs failed; rerun with --resubmit (and possibly --checkpoint)'
+      msg += ' to retry them.'
+      print(msg)
+      if args.runs_per_job is not None:
+        msg = 'Note: when all jobs are finished successfully, merge the run chunks using'
+        msg += ' python3 merge_runchunks.py -o {}'.format(args.outputdir)
+        print(msg)
+    elif args.runs_per_job is not None:
+      cmd = 'python3 merge_runchunks.py -o {}'.format(args.outputdir)
+      print(cmd)
+      os.system(cmd)
   else:
+    failed = []
     for cmd in cmds:
+      print(cmd)
+      if os.system(cmd)!=0: failed.append(cmd)
+    if len(failed)>0:
+      print('Note: {}/{} commands failed:'.format(len(failed), len(cmds)))
+      for cmd in failed: print('  - {}'.format(cmd))
+      msg = 'Note: rerun with --resubmit (and possibly --checkpoint) to retry them.'
+      print(msg)
+      if args.runs_per_job is not None:
+        msg = 'Note: the run chunks were not merged; when all jobs are finished successfully,'
+        msg += ' merge them using python3 merge_runchunks.py -o {}'.format(args.outputdir)
+        print(msg)
+    elif args.runs_per_job is not None:
+      cmd = 'python3 merge_runchunks.py -o {}'.format(args.outputdir)
       print(cmd)
       os.system(cmd)
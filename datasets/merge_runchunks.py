@@ -0,0 +1,143 @@
+#!/usr/bin/env python3
+
+
+# Merge the output files of jobs that were split in run chunks
+# (see the --runs-per-job option of get_data_dials_loop.py)
+# into the conventional <dataset>-<ME>.parquet files.
+# note: by default, nothing is merged if any job of any run chunk did not finish successfully
+#       (according to the list of jobs and their marker files written by get_data_dials_loop.py),
+#       since the merged files would then silently miss the runs of that chunk.
+#       output files that are missing in some run chunks of finished jobs are only reported
+#       (this is expected e.g. for dataset regexes, if a chunk has no runs for some dataset).
+
+
+# general imports
+import os
+import sys
+import glob
+import json
+import shutil
+import argparse
+import pyarrow.parquet as pq
+
+
+def get_runchunkdirs(outputdir):
+  ### get the run chunk directories in an output directory, sorted by first run
+  # note: depends on naming convention in get_data_dials_loop.py!
+  runchunkdirs = glob.glob(os.path.join(outputdir, 'runchunks', '*-*'))
+  runchunkdirs = [d for d in runchunkdirs if os.path.isdir(d)]
+  runchunkdirs = sorted(runchunkdirs, key=lambda d: int(os.path.basename(d).split('-')[0]))
+  return runchunkdirs
+
+def get_incomplete_jobs(outputdir):
+  ### get the jobs of the run chunks that did not finish successfully
+  # returns a list of (run chunk, job name) tuples,
+  # or None if the list of expected jobs is not available.
+  # note: depends on naming convention in get_data_dials_loop.py!
+  jobsfile = os.path.join(outputdir, 'runchunks', 'jobs.json')
+  if not os.path.exists(jobsfile): return None
+  with open(jobsfile, 'r') as f:
+    chunkjobs = json.load(f)
+  incomplete = []
+  for chunkname, jobnames in chunkjobs.items():
+    for jobname in jobnames:
+      donefile = os.path.join(outputdir, 'runchunks', chunkname, 'done', jobname)
+      if not os.path.exists(donefile): incomplete.append((chunkname, jobname))
+  return incomplete
+
+def merge_files(inputfiles, outputfile):
+  ### merge parquet files with the same schema into a single file
+  # note: the input files are copied row group by row group,
+  #       so the memory usage is bounded by the size of a single row group.
+  # note: the output is first written to a temporary file and then renamed.
+  # note: the data format metadata (e.g. the binning for the tensor data format)
+  #       must be the same in all input files.
+  writer = None
+  for idx, inputfile in enumerate(inputfiles):
+    pfile = pq.ParquetFile(inputfile)
+    metadata = (pfile.schema_arrow.metadata or {}).get(b'dialstools')
+    if idx==0: refmetadata = metadata
+    elif metadata!=refmetadata:
+      if writer is not None:
+        writer.close()
+        os.remove(outputfile+'.tmp')
+      msg = 'ERROR: data format (or binning) of {} does not match {}.'.format(inputfile, inputfiles[0])
+      raise Exception(msg)
+    for groupidx in range(pfile.num_row_groups):
+      table = pfile.read_row_group(groupidx)
+      if writer is None:
+        schema = table.schema
+        writer = pq.ParquetWriter(outputfile+'.tmp', schema)
+      writer.write_table(table.cast(schema))
+  if writer is None: return
+  writer.close()
+  os.replace(outputfile+'.tmp', outputfile)
+
+
+if __name__=='__main__':
+
+  # read arguments
+  parser = argparse.ArgumentParser(description='Merge run chunks')
+  parser.add_argument('-o', '--outputdir', required=True,
+    help='Output directory that was used in get_data_dials_loop.py'
+        +' (the run chunks are expected in its runchunks subdirectory).')
+  parser.add_argument('--clean', default=False, action='store_true',
+    help='Remove the run chunk directories after successful merging.')
+  parser.add_argument('--allowmissing', default=False, action='store_true',
+    help='Merge the output files even if some jobs of the run chunks did not finish successfully'
+        +' (by default, nothing is merged in that case).')
+  args = parser.parse_args()
+
+  # print arguments
+  print('Running with following configuration:')
+  for arg in vars(args):
+    print('  - {}: {}'.format(arg,getattr(args,arg)))
+
+  # find run chunks
+  runchunkdirs = get_runchunkdirs(args.outputdir)
+  print('Found {} run chunks'.format(len(runchunkdirs)))
+  if len(runchunkdirs)==0: sys.exit()
+
+  # group the files in each run chunk by name
+  filedict = {}
+  for runchunkdir in runchunkdirs:
+    for inputfile in sorted(glob.glob(os.path.join(runchunkdir, '*.parquet'))):
+      filename = os.path.basename(inputfile)
+      if filename not in filedict: filedict[filename] = []
+      filedict[filename].append(inputfile)
+
+  # check that all jobs of all run chunks finished successfully
+  incomplete = get_incomplete_jobs(args.outputdir)
+  if incomplete is None:
+    print('WARNING: no list of jobs found, cannot check if all run chunks are complete.')
+  elif len(incomplete)>0:
+    print('Found {} jobs that did not finish successfully:'.format(len(incomplete)))
+    for (chunkname, jobname) in incomplete: print('  - run chunk {}: {}'.format(chunkname, jobname))
+    if not args.allowmissing:
+      msg = 'ERROR: some run chunks are incomplete'
+      msg += ' (resubmit the corresponding jobs, or use --allowmissing to merge anyway).'
+      raise Exception(msg)
+
+  # report output files that are missing in some run chunks
+  missing = {filename: [d for d in runchunkdirs if os.path.join(d, filename) not in inputfiles]
+             for filename, inputfiles in filedict.items()}
+  missing = {filename: dirs for filename, dirs in missing.items() if len(dirs)>0}
+  if len(missing)>0:
+    msg = 'Note: {} output files are missing in some run chunks'.format(len(missing))
+    msg += ' (expected if a run chunk contains no runs for a dataset):'
+    print(msg)
+    for filename, dirs in missing.items():
+      print('  - {}: missing in {}'.format(filename, ', '.join([os.path.basename(d) for d in dirs])))
+
+  # merge the files
+  print('Merging {} output files...'.format(len(filedict)))
+  for filename, inputfiles in filedict.items():
+    outputfile = os.path.join(args.outputdir, filename)
+    print('  - {} ({} run chunks)'.format(outputfile, len(inputfiles)))
+    sys.stdout.flush()
+    merge_files(inputfiles, outputfile)
+
+  # remove run chunks (if requested)
+  if args.clean:
+    print('Removing run chunks...')
+    shutil.rmtree(os.path.join(args.outputdir, 'runchunks'))
@@ -0,0 +1,88 @@
+#!/usr/bin/env python3
+
+
+# Summarize the progress files written by get_data_dials.py
+# (see the --progressfile option and dials_progress.py)
+
+
+# general imports
+import sys
+import json
+import argparse
+
+
+def read_events(progressfile):
+  ### read the events from a progress file
+  # note: incomplete lines (e.g. for a job that is still running) are skipped.
+  events = []
+  with open(progressfile, 'r') as f:
+    for line in f:
+      try: events.append(json.loads(line))
+      except ValueError: continue
+  return events
+
+def summarize_job(events):
+  ### summarize the events of a single job
+  # returns a dict with the status, progress and totals of the job.
+  info = {'status': 'unknown', 'progress': 0., 'dataset': None, 'me': None,
+          'runs': 0, 'rows': 0, 'bytes': 0, 'retries': 0, 'elapsed': 0.}
+  if len(events)==0: return info
+  info['status'] = 'running'
+  starttime = events[0]['time']
+  info['elapsed'] = events[-1]['time'] - starttime
+  for event in events:
+    if event['event']=='dataset': info['dataset'] = event['dataset']
+    elif event['event']=='me':
+      info['me'] = event['me']
+      info['progress'] = 0.
+    elif event['event']=='run':
+      info['runs'] += 1
+      if event['total']>0: info['progress'] = event['index']/event['total']
+    elif event['event']=='request':
+      for key in ['rows', 'bytes', 'retries']: info[key] += event[key]
+    elif event['event']=='summary':
+      info['status'] = 'finished'
+      info['progress'] = 1.
+      info['elapsed'] = event['elapsed']
+  return info
+
+
+if __name__=='__main__':
+
+  # read arguments
+  parser = argparse.ArgumentParser(description='Summarize progress files')
+  parser.add_argument('-i', '--inputfiles', required=True, nargs='+',
+    help='Paths to progress files written by get_data_dials.py (with --progressfile).')
+  parser.add_argument('-n', '--nslowest', default=5, type=int,
+    help='Number of slowest requests to show (default: 5).')
+  args = parser.parse_args()
+
+  # read and summarize each job
+  allrequests = []
+  totals = {'rows': 0, 'bytes': 0, 'retries': 0}
+  for inputfile in sorted(args.inputfiles):
+    events = read_events(inputfile)
+    info = summarize_job(events)
+    allrequests += [event for event in events if event['event']=='request']
+    for key in totals.keys(): totals[key] += info[key]
+    msg = '{}: {} ({:.1f}%, dataset: {}, ME: {})'.format(inputfile, info['status'],
+            info['progress']*100, info['dataset'], info['me'])
+    msg += ', {} runs, {} rows, {:.1f} MB, {} retries in {:.1f} s'.format(
+            info['runs'], info['rows'], info['bytes']/1024**2, info['retries'], info['elapsed'])
+    if info['elapsed']>0:
+      msg += ' ({:.1f} rows/s, {:.2f} MB/s)'.format(
+               info['rows']/info['elapsed'], info['bytes']/1024**2/info['elapsed'])
+    print(msg)
+
+  # print totals
+  print('Total: {} rows, {:.1f} MB, {} retries'.format(
+        totals['rows'], totals['bytes']/1024**2, totals['retries']))
+
+  # print slowest requests
+  if len(allrequests)==0: sys.exit()
+  print('Slowest requests:')
+  allrequests = sorted(allrequests, key=lambda event: event['latency'], reverse=True)
+  for event in allrequests[:args.nslowest]:
+    print('  - {:.1f} s: dataset {}, ME {}, runs {} ({} rows, {} pages, {} retries)'.format(
+          event['latency'], event['dataset'], event['me'], event['runs'],
+          event['rows'], event['pages'], event['retries']))
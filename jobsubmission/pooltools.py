@@ -0,0 +1,78 @@
+##########################################################################
+# functionality for running a list of commands locally in a process pool #
+##########################################################################
+
+# general use:
+# an alternative to condor submission (see condortools.py)
+# for interactive machines with many cores:
+# the commands are run in parallel as separate processes on the local machine,
+# with a fixed maximum number of processes running at the same time.
+# the output and error streams of each command are written to log files
+# with the same naming convention as for condor jobs
+# (e.g. cjob_name_out_<cluster id>_<index>), so that the same tools
+# can be used for checking the job status (e.g. jobcheck.py).
+
+import os
+import sys
+import time
+import subprocess
+from concurrent.futures import ThreadPoolExecutor
+
+def runCommand(command, stdout, stderr):
+    ### run a single command in a separate process, with output and error streams written to files
+    # returns the exit code of the command and the time it took (in seconds)
+    starttime = time.time()
+    with open(stdout, 'w') as fout, open(stderr, 'w') as ferr:
+        process = subprocess.run(command, shell=True, stdout=fout, stderr=ferr)
+    return (process.returncode, time.time()-starttime)
+
+def runCommandsInPool(name, commands, jobs=None, clusterid=None, verbose=True):
+    ### run a list of commands in parallel on the local machine
+    # input arguments:
+    # - name: base name for the log files
+    #   (the output and error of command i is written to <name>_out_<clusterid>_<i>
+    #   and <name>_err_<clusterid>_<i> respectively).
+    # - commands: list of strings, each string represents a single command (executable + args).
+    # - jobs: maximum number of commands running at the same time (default: number of cores).
+    # - clusterid: identifier for the log files (default: current time stamp).
+    # - verbose: print a line for each finished command and a summary at the end.
+    # returns:
+    # a list of dicts with info (index, command, log files, exit code and time)
+    # for each command that failed (i.e. with a nonzero exit code).
+    # note: the commands themselves run in separate processes;
+    #       the pool only consists of threads waiting for them to finish.
+    name = os.path.splitext(name)[0]
+    if jobs is None: jobs = os.cpu_count()
+    if clusterid is None: clusterid = time.strftime('%Y%m%d%H%M%S')
+    starttime = time.time()
+    infos = []
+    for idx, command in enumerate(commands):
+        infos.append({
+          'index': idx,
+          'command': command,
+          'stdout': '{}_out_{}_{}'.format(name, clusterid, idx),
+          'stderr': '{}_err_{}_{}'.format(name, clusterid, idx)
+        })
+    if verbose:
+        print('Running {} commands with {} parallel jobs'.format(len(commands), jobs))
+        print('(log files: {}_out_{}_*, {}_err_{}_*)'.format(name, clusterid, name, clusterid))
+        sys.stdout.flush()
+    def run(info):
+        (info['returncode'], info['time']) = runCommand(info['command'], info['stdout'], info['stderr'])
+        if verbose:
+            status = 'finished' if info['returncode']==0 else 'failed (exit code {})'.format(info['returncode'])
+            print('  - Command {}/{} {} after {:.1f} s'.format(info['index']+1, len(commands), status, info['time']))
+            sys.stdout.flush()
+        return info
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        infos = list(executor.map(run, infos))
+    failed = [info for info in infos if info['returncode']!=0]
+    if verbose:
+        print('Summary: {}/{} commands finished successfully in {:.1f} s'.format(
+              len(commands)-len(failed), len(commands), time.time()-starttime))
+        if len(failed)>0:
+            print('The following commands failed:')
+            for info in failed:
+                print('  - {} (exit code {}, see {})'.format(info['command'], info['returncode'], info['stderr']))
+        sys.stdout.flush()
+    return failed
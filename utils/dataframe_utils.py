@@ -12,9 +12,13 @@
 
 # external modules
 import os
+import glob
 import json
 import pandas as pd
 import numpy as np
+import pyarrow as pa
+import pyarrow.parquet as pq
+import pyarrow.dataset as ds
 
 # local modules
 import json_utils
@@ -74,14 +78,15 @@ def select_ls(df, lsnbs, lumicolumn='ls_number'):
 
 def get_runsls(df, runcolumn='run_number', lumicolumn='ls_number'):
     ### return a dictionary with runs and lumisections in a dataframe (same format as e.g. golden json)
-    runslslist = get_runs(df, runcolum=runcolumn)
-    for i,run in enumerate(runslslist):
-        runslslist[i] = (run, get_ls( select_runs(df,[run],runcolumn=runcolumn), lumicolumn=lumicolumn))
-    return json_utils.tuplelist_to_jsondict( runslslist )
+    # note: all runs are processed at once (see json_utils.runsls_to_jsondict),
+    #       and lumisections that appear multiple times (e.g. for multiple MEs) are counted once.
+    return json_utils.runsls_to_jsondict( df[runcolumn].values, df[lumicolumn].values )
 
-def select_json(df, jsonfile, runcolumn='run_number', lumicolumn='ls_number'):
+def select_json(df, jsonfile, runcolumn='run_number', lumicolumn='ls_number', check=True):
     ### keep only lumisections that are in the given json file
-    dfres = df[ json_utils.injson( df[runcolumn].values, df[lumicolumn].values, jsonfile=jsonfile) ]
+    # note: the json file is only read again if it was modified (see json_utils.load_lumimask);
+    #       with check=False, the cached version is used without checking the file at all.
+    dfres = df[ json_utils.injson( df[runcolumn].values, df[lumicolumn].values, jsonfile=jsonfile, check=check) ]
     dfres.reset_index(drop=True, inplace=True)
     return dfres
 
@@ -89,4 +94,74 @@ def select_runsls(df, jsondict, runcolumn='run_number', lumicolumn='ls_number'):
     ### equivalent to select_json but using a pre-loaded json dict instead of a json file on disk
     dfres = df[ json_utils.injson( df[runcolumn].values, df[lumicolumn].values, jsondict=jsondict) ]
     dfres.reset_index(drop=True, inplace=True)
-    return dfres
\ No newline at end of file
+    return dfres
+
+
+### reading parquet files in tensor data format
+
+def read_tensor_parquet(parquetfile, runs=None, columns=None, runcolumn='run_number'):
+    ### read a parquet file written by get_data_dials.py with the tensor data format
+    # input arguments:
+    # - parquetfile: path to the parquet file
+    # - runs: list of run numbers to read (default: all runs in the file)
+    # - columns: list of columns to read in addition to the histograms (default: all columns)
+    # returns:
+    # a tuple (df, hists, meta) with:
+    # - df: dataframe with the requested columns (except the histograms)
+    # - hists: numpy array of shape (nhistograms,nbins) for 1D or (nhistograms,nybins,nxbins) for 2D
+    # - meta: dict with the binning (x_min, x_max, x_bin and similar for y), shape and dtype
+    # note: the histograms are converted in one go from the underlying arrow buffer,
+    #       without per-row copies (as opposed to e.g. np.dstack(df['data'].values)).
+    filters = None
+    if runs is not None: filters = [(runcolumn, 'in', list(runs))]
+    if columns is not None: columns = [c for c in columns if c!='data'] + ['data']
+    table = pq.read_table(parquetfile, columns=columns, filters=filters)
+    if table.schema.metadata is None or b'dialstools' not in table.schema.metadata:
+        raise Exception('ERROR in dataframe_utils.py / read_tensor_parquet: file {}'.format(parquetfile)
+                       +' does not seem to be in tensor data format.')
+    meta = json.loads(table.schema.metadata[b'dialstools'])
+    data = table.column('data').combine_chunks()
+    hists = data.flatten().to_numpy().reshape([len(table)]+meta['shape'])
+    df = table.drop_columns(['data']).to_pandas()
+    return (df, hists, meta)
+
+
+### reading partitioned parquet datasets
+
+def read_partitioned_parquet(path, workspace=None, datasets=None, mes=None, runs=None, columns=None):
+    ### read (a selection of) a partitioned parquet dataset written by get_data_dials.py
+    # (i.e. using the option --outputlayout hive)
+    # input arguments:
+    # - path: root directory of the partitioned dataset
+    # - workspace: DIALS workspace (or list of workspaces) to read (default: all)
+    # - datasets: dataset name (or list of dataset names) to read (default: all)
+    # - mes: ME name (or list of ME names) to read (default: all)
+    # - runs: run number (or list of run numbers) to read (default: all)
+    # - columns: list of columns to read (default: all)
+    # returns:
+    # a dataframe with the selected rows and columns
+    # note: the selection is applied to the partition directories,
+    #       so only the files for the requested runs and MEs are actually read.
+    # note: for the tensor data format, only one ME can be read at the same time,
+    #       see also read_tensor_parquet.
+    # note: only the files in the workspace=* partitions are read,
+    #       other files below the root directory (if any) are ignored.
+    partitioning = ds.partitioning(pa.schema([
+        ('workspace', pa.string()),
+        ('dataset', pa.string()),
+        ('me', pa.string()),
+        ('run_number', pa.int64())]), flavor='hive')
+    files = glob.glob(os.path.join(glob.escape(path), 'workspace=*', '**', '*.parquet'), recursive=True)
+    if len(files)==0:
+        raise Exception('ERROR in dataframe_utils.py / read_partitioned_parquet: no partitions found in {}'.format(path))
+    dataset = ds.dataset(sorted(files), format='parquet', partitioning=partitioning, partition_base_dir=path)
+    selection = None
+    for field, values in [('workspace', workspace), ('dataset', datasets), ('me', mes), ('run_number', runs)]:
+        if values is None: continue
+        if( isinstance(values, str) or not hasattr(values, '__len__') ): values = [values]
+        expression = ds.field(field).isin(list(values))
+        if selection is None: selection = expression
+        else: selection = selection & expression
+    table = dataset.to_table(columns=columns, filter=selection)
+    return table.to_pandas()
+
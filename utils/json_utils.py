@@ -4,7 +4,11 @@
 # **A collection of useful basic functions for manipulating json files.**  
 # Functionality includes:
 # - reading and writing json files for given sets of run numbers and lumisection numbers
+#   (optionally with a cache in memory, for repeatedly reading the same files)
 # - checking if a given run number, lumisection number or combination is present in a given json file
+#   (optionally using a compiled lumisection mask, for fast checking of many combinations at once)
+# - set operations (union, intersection, difference) and lumisection counts on json files
+# - conversions between json dicts and other formats (e.g. arrays of run and lumisection numbers)
 # 
 # Note that the json files are always assumed to contain the following structure:  
 # - dict  
@@ -25,7 +29,9 @@
 import os
 import sys
 import json
+import threading
 import numpy as np
+from collections import OrderedDict
 
 
 ### reading and writing json files
@@ -57,6 +63,294 @@ def writejson( jsondict, outputfile, overwrite=False ):
     with open(outputfile,'w') as f: json.dump(jsondict,f)
 
 
+### compiled lumisection masks
+
+class LumiMask(object):
+    ### compiled version of a json dict, for fast checking of many run/lumi combinations
+    # the lumisection ranges are stored as sorted int64 arrays of run numbers,
+    # first and last lumisection numbers (with overlapping or adjacent ranges merged),
+    # so that arrays of run/lumi combinations can be checked with a single binary search,
+    # instead of looping over all combinations and ranges in python.
+    # set operations (union, intersection, difference) and lumisection counts
+    # are done directly on the ranges, so their cost scales with the number of ranges
+    # rather than with the number of lumisections.
+    # note: the [-1] convention (all lumisections within a run) is supported,
+    #       it is stored as the range [1, lumimax] (see below).
+    # note: lumisection numbers start at 1, lower range boundaries are clipped to 1.
+    # usage example:
+    #   mask = LumiMask( loadjson('golden.json') )
+    #   res = mask.contains( df['run_number'].values, df['ls_number'].values )
+    #   jsondict = ( mask & LumiMask( loadjson('dcs.json') ) ).to_jsondict()
+
+    # minimum and maximum lumisection number that can be represented
+    # (lumimax is also used as the open upper boundary for runs with all lumisections)
+    lumimin = -2**31
+    lumimax = 2**31-1
+
+    def __init__( self, jsondict ):
+        ### initializer
+        # input arguments:
+        # - jsondict: a dict loaded from a json file
+        runs = []
+        starts = []
+        stops = []
+        for run, lumiranges in jsondict.items():
+            for lumirange in lumiranges:
+                if( len(lumirange)==1 and lumirange[0]<0 ):
+                    runs.append(int(run)); starts.append(1); stops.append(self.lumimax)
+                elif len(lumirange)==2:
+                    runs.append(int(run)); starts.append(lumirange[0]); stops.append(lumirange[1])
+                else:
+                    raise Exception('ERROR in json_utils.py / LumiMask: found range specifier {} for run {}'.format(lumirange, run)
+                                   +' while [first, last] or [-1] is required')
+        runs = np.array(runs, dtype=np.int64)
+        starts = np.array(starts, dtype=np.int64)
+        stops = np.array(stops, dtype=np.int64)
+        starts = np.maximum(starts, 1)
+        # remove empty ranges
+        keep = (starts<=stops)
+        self.set_keys( self.make_keys(runs[keep], starts[keep]), self.make_keys(runs[keep], stops[keep]) )
+
+    @classmethod
+    def make_keys( cls, run, lumi ):
+        ### helper function to combine run and lumisection numbers into sortable int64 keys
+        # note: run numbers are assumed to be in [0, 2**31),
+        #       lumisection numbers are clipped to [lumimin, lumimax].
+        run = np.asarray(run, dtype=np.int64)
+        lumi = np.clip(np.asarray(lumi, dtype=np.int64), cls.lumimin, cls.lumimax)
+        return (run << 32) + (lumi - cls.lumimin)
+
+    @classmethod
+    def from_keys( cls, startkeys, stopkeys ):
+        ### make a LumiMask from arrays of first and last keys (see make_keys) of lumisection ranges
+        mask = cls( {} )
+        mask.set_keys( startkeys, stopkeys )
+        return mask
+
+    def set_keys( self, startkeys, stopkeys ):
+        ### helper function to set the ranges from arrays of first and last keys (see make_keys)
+        # note: the ranges are sorted, and overlapping or adjacent ranges within the same run are merged.
+        startkeys = np.asarray(startkeys, dtype=np.int64)
+        stopkeys = np.asarray(stopkeys, dtype=np.int64)
+        order = np.argsort(startkeys, kind='stable')
+        (startkeys, stopkeys) = (startkeys[order], stopkeys[order])
+        if len(startkeys)>0:
+            runs = (startkeys >> 32)
+            maxstops = np.maximum.accumulate(stopkeys)
+            newrange = np.ones(len(startkeys), dtype=bool)
+            newrange[1:] = ( (runs[1:]!=runs[:-1]) | (startkeys[1:]>maxstops[:-1]+1) )
+            firsts = np.flatnonzero(newrange)
+            lasts = np.append(firsts[1:]-1, len(startkeys)-1)
+            (startkeys, stopkeys) = (startkeys[firsts], maxstops[lasts])
+        self.startkeys = startkeys
+        self.stopkeys = stopkeys
+        self.runs = (startkeys >> 32)
+        self.starts = (startkeys & 0xFFFFFFFF) + self.lumimin
+        self.stops = (stopkeys & 0xFFFFFFFF) + self.lumimin
+
+    def contains( self, run, lumi ):
+        ### check which run/lumi combinations are in the mask
+        # input arguments:
+        # - run and lumi: integers or (equally long) arrays of integers
+        # output:
+        # - boolean or array of booleans (depending on run and lumi)
+        run = np.asarray(run, dtype=np.int64)
+        lumi = np.asarray(lumi, dtype=np.int64)
+        if len(self.runs)==0: return np.zeros(run.shape, dtype=bool)
+        idx = np.searchsorted(self.startkeys, self.make_keys(run, lumi), side='right') - 1
+        found = (idx>=0)
+        idx = np.maximum(idx, 0)
+        return found & (self.runs[idx]==run) & (lumi<=self.stops[idx])
+
+    def combine( self, other, operation ):
+        ### helper function for the set operations
+        # input arguments:
+        # - other: another LumiMask (or a json dict)
+        # - operation: function taking two boolean arrays (whether a key is in self and in other)
+        #   and returning a boolean array (whether the key should be in the result)
+        # output:
+        # - a new LumiMask
+        # note: the union of the range boundaries of both masks splits the keys into segments
+        #       that are either fully inside or fully outside of each mask,
+        #       so it is sufficient to evaluate the operation once per segment.
+        if not isinstance(other, LumiMask): other = LumiMask( other )
+        boundaries = np.unique(np.concatenate([self.startkeys, self.stopkeys+1, other.startkeys, other.stopkeys+1]))
+        if len(boundaries)<2: return LumiMask( {} )
+        (startkeys, stopkeys) = (boundaries[:-1], boundaries[1:]-1)
+        keep = operation( self.contains_keys(startkeys), other.contains_keys(startkeys) )
+        return LumiMask.from_keys( startkeys[keep], stopkeys[keep] )
+
+    def contains_keys( self, keys ):
+        ### helper function to check which keys (see make_keys) are in the mask
+        if len(self.startkeys)==0: return np.zeros(len(keys), dtype=bool)
+        idx = np.searchsorted(self.startkeys, keys, side='right') - 1
+        return (idx>=0) & (keys<=self.stopkeys[np.maximum(idx, 0)])
+
+    def union( self, other ):
+        ### return a new LumiMask with the lumisections in self or in other (or both)
+        if not isinstance(other, LumiMask): other = LumiMask( other )
+        return LumiMask.from_keys( np.concatenate([self.startkeys, other.startkeys]),
+                                   np.concatenate([self.stopkeys, other.stopkeys]) )
+
+    def intersection( self, other ):
+        ### return a new LumiMask with the lumisections in both self and other
+        return self.combine( other, np.logical_and )
+
+    def difference( self, other ):
+        ### return a new LumiMask with the lumisections in self but not in other
+        return self.combine( other, lambda a, b: (a & ~b) )
+
+    def __or__( self, other ): return self.union( other )
+    def __and__( self, other ): return self.intersection( other )
+    def __sub__( self, other ): return self.difference( other )
+
+    def count( self, lscounts=None, per_run=False ):
+        ### count the number of lumisections in the mask
+        # input arguments:
+        # - lscounts: optional dict mapping run numbers to their number of lumisections;
+        #   if specified, only lumisections 1 up to that number are counted for those runs.
+        #   this is needed for runs with all lumisections (the [-1] convention)
+        #   or with ranges extending up to lumimax (e.g. the difference of [-1] with another range).
+        # - per_run: if True, return a dict mapping each run number to its count.
+        # output:
+        # - the total number of lumisections (or a dict, see per_run)
+        starts = self.starts
+        stops = self.clip_stops( lscounts )
+        if np.any( (stops==self.lumimax) & (starts<=stops) ):
+            runs = sorted(set(self.runs[stops==self.lumimax].tolist()))
+            raise Exception('ERROR in json_utils.py / LumiMask.count: the number of lumisections is unknown'
+                           +' for runs {}, please specify them in lscounts.'.format(runs))
+        counts = np.maximum(stops-starts+1, 0)
+        if not per_run: return int(counts.sum())
+        (runs, inverse) = np.unique(self.runs, return_inverse=True)
+        return dict(zip(runs.tolist(), np.bincount(inverse, weights=counts, minlength=len(runs)).astype(np.int64).tolist()))
+
+    def clip_stops( self, lscounts=None ):
+        ### helper function to clip the last lumisection of each range to the number of lumisections in its run
+        # (see count), runs that are not in lscounts are left unchanged.
+        if lscounts is None: return self.stops.copy()
+        maxlumis = np.array([lscounts.get(run, lscounts.get(str(run), self.lumimax)) for run in self.runs.tolist()],
+                            dtype=np.int64)
+        return np.minimum(self.stops, maxlumis)
+
+    def to_jsondict( self, lscounts=None ):
+        ### convert the mask back to a json dict
+        # input arguments:
+        # - lscounts: optional dict mapping run numbers to their number of lumisections,
+        #   used to close ranges extending up to lumimax (e.g. the difference of [-1] with another range).
+        # note: full ranges [1, lumimax] are written as [-1];
+        #       other ranges are written as [first, last].
+        #       an exception is raised for other ranges extending up to lumimax
+        #       if the number of lumisections in their run is not in lscounts.
+        full = (self.starts==1) & (self.stops==self.lumimax)
+        stops = self.clip_stops( lscounts )
+        if np.any( ~full & (stops==self.lumimax) ):
+            runs = sorted(set(self.runs[~full & (stops==self.lumimax)].tolist()))
+            raise Exception('ERROR in json_utils.py / LumiMask.to_jsondict: the number of lumisections is unknown'
+                           +' for runs {}, please specify them in lscounts.'.format(runs))
+        jsondict = {}
+        for run, start, stop, isfull in zip(self.runs.tolist(), self.starts.tolist(), stops.tolist(), full.tolist()):
+            if isfull: lumirange = [-1]
+            elif start<=stop: lumirange = [start, stop]
+            else: continue
+            jsondict.setdefault(str(run), []).append(lumirange)
+        return jsondict
+
+    def __len__( self ):
+        ### number of (merged) lumisection ranges in the mask
+        return len(self.runs)
+
+
+### set operations on json dicts
+
+def jsondict_union( *jsondicts ):
+    ### return a json dict with the lumisections that are in any of the given json dicts (or LumiMasks)
+    mask = LumiMask( {} )
+    for jsondict in jsondicts: mask = mask.union( jsondict )
+    return mask.to_jsondict()
+
+def jsondict_intersection( *jsondicts ):
+    ### return a json dict with the lumisections that are in all of the given json dicts (or LumiMasks)
+    if len(jsondicts)==0: return {}
+    mask = jsondicts[0] if isinstance(jsondicts[0], LumiMask) else LumiMask( jsondicts[0] )
+    for jsondict in jsondicts[1:]: mask = mask.intersection( jsondict )
+    return mask.to_jsondict()
+
+def jsondict_difference( jsondict, *others, lscounts=None ):
+    ### return a json dict with the lumisections in jsondict that are not in any of the others
+    # (each of which can be a json dict or a LumiMask)
+    # note: lscounts is needed if the result contains parts of runs with all lumisections
+    #       (the [-1] convention), see LumiMask.to_jsondict.
+    mask = jsondict if isinstance(jsondict, LumiMask) else LumiMask( jsondict )
+    for other in others: mask = mask.difference( other )
+    return mask.to_jsondict( lscounts=lscounts )
+
+def jsondict_count( jsondict, lscounts=None, per_run=False ):
+    ### return the number of lumisections in a json dict (or LumiMask), see LumiMask.count
+    mask = jsondict if isinstance(jsondict, LumiMask) else LumiMask( jsondict )
+    return mask.count( lscounts=lscounts, per_run=per_run )
+
+
+### cached loading of json files
+
+# cache for loadjson_cached and load_lumimask,
+# mapping (type of object, path) to (modification time, size, object),
+# with the least recently used entries first
+jsoncache = OrderedDict()
+jsoncache_lock = threading.Lock()
+jsoncache_maxsize = 32
+
+def cached_load( jsonfile, kind, loader, check=True ):
+    ### helper function for loadjson_cached and load_lumimask, only for internal use
+    # input arguments:
+    # - jsonfile: path to a json file
+    # - kind: type of object to cache (used in the cache key)
+    # - loader: function to make the object from the path to the json file
+    # - check: if True, the modification time and size of the file are checked on every call
+    #   (which requires a stat call, but not reading the file),
+    #   and the file is loaded again if any of them changed;
+    #   if False, a cached object is returned without accessing the file at all.
+    path = os.path.abspath(jsonfile)
+    key = (kind, path)
+    if not check:
+        with jsoncache_lock:
+            if key in jsoncache:
+                jsoncache.move_to_end(key)
+                return jsoncache[key][2]
+    try: stat = os.stat(path)
+    except FileNotFoundError:
+        raise Exception('ERROR in json_utils.py / cached_load: requested json file {} does not seem to exist...'.format(jsonfile))
+    with jsoncache_lock:
+        entry = jsoncache.get(key, None)
+        if( entry is not None and entry[0]==stat.st_mtime_ns and entry[1]==stat.st_size ):
+            jsoncache.move_to_end(key)
+            return entry[2]
+    obj = loader( path )
+    with jsoncache_lock:
+        jsoncache[key] = (stat.st_mtime_ns, stat.st_size, obj)
+        jsoncache.move_to_end(key)
+        while len(jsoncache)>jsoncache_maxsize: jsoncache.popitem(last=False)
+    return obj
+
+def loadjson_cached( jsonfile, check=True ):
+    ### same as loadjson, but the result is cached in memory
+    # (e.g. for repeatedly loading the same golden or DCS json file, or dataset and ME lists, from a network file system)
+    # input arguments:
+    # - jsonfile: the name (or full path if needed) to the json file to be read
+    # - check: whether to check if the file was modified since it was cached (see cached_load)
+    # note: the cache holds at most jsoncache_maxsize objects, the least recently used ones are removed first.
+    # note: the returned object is shared with the cache, so it should not be modified.
+    return cached_load( jsonfile, 'json', loadjson, check=check )
+
+def load_lumimask( jsonfile, check=True ):
+    ### load a json file into a LumiMask, using a cache in memory (see loadjson_cached)
+    return cached_load( jsonfile, 'lumimask', lambda path: LumiMask( loadjson(path) ), check=check )
+
+def clear_jsoncache():
+    ### remove all entries from the cache of loadjson_cached and load_lumimask
+    with jsoncache_lock: jsoncache.clear()
+
+
 ### checking if given run/lumi values are in a given json object
 
 def injson_single( run, lumi, jsondict ):
@@ -76,13 +370,16 @@ def injson_single( run, lumi, jsondict ):
             return True
     return False
 
-def injson( run, lumi, jsonfile=None, jsondict=None ):
+def injson( run, lumi, jsonfile=None, jsondict=None, check=True ):
     ### find if a run and lumi combination is in a given json file
     # input arguments:
     # - run and lumi: integers or (equally long) arrays of integers
     # - jsonfile: a path to a json file
-    # - jsondict: a dict loaded from a json file
+    #   (loaded with load_lumimask, so repeated calls with the same file do not read it again)
+    # - jsondict: a dict loaded from a json file, or a LumiMask
     #   note: either jsonfile or jsondict must not be None!
+    # - check: only used with jsonfile; whether to check if the file was modified since it was cached
+    #   (see cached_load); use False to skip the stat call on repeated calls with a file that does not change
     # output: 
     # boolean or array of booleans (depending on run and lumi)
     
@@ -92,7 +389,8 @@ def injson( run, lumi, jsonfile=None, jsondict=None ):
     if( jsonfile is not None and jsondict is not None ):
         raise Exception('ERROR in json_utils.py / injson: both arguments jsonfile and jsondict are given, which leads to ambiguities. Omit one of both!')
     if jsondict is None:
-        jsondict = loadjson( jsonfile )
+        jsondict = load_lumimask( jsonfile, check=check )
+    mask = jsondict if isinstance(jsondict, LumiMask) else None
         
     # check if single or multiple run/lumi combinations need to be assessed    
     if not hasattr(run,'__len__') and not isinstance(run,str):
@@ -100,8 +398,10 @@ def injson( run, lumi, jsonfile=None, jsondict=None ):
     res = np.zeros(len(run),dtype=np.int8)
     
     # check for all run/lumi combinations if they are in the json object
-    for i,(r,l) in enumerate(zip(run,lumi)):
-        if injson_single( r, l, jsondict ): res[i]=1
+    # (using a compiled lumisection mask, see LumiMask)
+    if len(res)>0:
+        if mask is None: mask = LumiMask( jsondict )
+        res = mask.contains( run, lumi )
     res = res.astype(bool)
     if len(res)==1: res = res[0]
     return res
@@ -116,33 +416,39 @@ def plainlist_to_rangelist( plainlist ):
     # output:
     # - a list lists representing ranges
     # example: [1,2,3,5,6] -> [ [1,3], [5,6] ]
+    # note: a new range is started wherever two consecutive elements do not differ by exactly 1,
+    #       this is done for all elements at once using numpy.
     
     if len(plainlist)==0: return []
-    if len(plainlist)==1: return [[plainlist[0],plainlist[0]]]
-    start_index = 0
-    stop_index = 1
-    rangelist = []
-    while stop_index < len(plainlist):
-        if plainlist[stop_index]==plainlist[stop_index-1]+1:
-            stop_index += 1
-        else:
-            rangelist.append( [ plainlist[start_index],plainlist[stop_index-1] ] )
-            start_index = stop_index
-            stop_index = stop_index+1
-    rangelist.append( [ plainlist[start_index],plainlist[stop_index-1] ] )
-    return rangelist
+    plainlist = np.asarray(plainlist)
+    breaks = np.flatnonzero(np.diff(plainlist)!=1)+1
+    starts = plainlist[np.concatenate(([0],breaks))]
+    stops = plainlist[np.concatenate((breaks-1,[len(plainlist)-1]))]
+    return np.stack((starts,stops),axis=1).tolist()
     
 
 def rangelist_to_plainlist( rangelist ):
     ### inverse function of plainlist_to_rangelist, for internal use only
-    plainlist = []
     for el in rangelist:
         if len(el)!=2:
             raise Exception('ERROR in json_utils.py / rangelist_to_plainlist: found range specifier with length {}'.format(len(el))
                            +' while 2 is required [first, last]')
-        for number in range(el[0],el[1]+1):
-            plainlist.append(number)
-    return plainlist
+    if len(rangelist)==0: return []
+    rangearray = np.array(rangelist, dtype=np.int64).reshape(-1,2)
+    return expand_ranges( rangearray[:,0], rangearray[:,1] ).tolist()
+
+
+def expand_ranges( starts, stops ):
+    ### helper function to expand arrays of ranges into an array of all numbers in them, only for internal use
+    # input arguments:
+    # - starts and stops: equally long arrays of first and last numbers of each range (inclusive)
+    # output:
+    # - a numpy array with the numbers in each range, in the same order as the ranges
+    #   (ranges with stop < start are empty)
+    starts = np.asarray(starts, dtype=np.int64)
+    lengths = np.maximum(np.asarray(stops, dtype=np.int64)-starts+1, 0)
+    offsets = np.cumsum(lengths)-lengths
+    return np.repeat(starts-offsets, lengths) + np.arange(lengths.sum(), dtype=np.int64)
 
 
 def tuplelist_to_jsondict( tuplelist ):
@@ -170,4 +476,59 @@ def jsondict_to_tuplelist( jsondict ):
         else:
             lslist = rangelist_to_plainlist( lumiranges )
         tuplelist.append( (int(runnb), lslist) )
-    return tuplelist
\ No newline at end of file
+    return tuplelist
+
+
+def runsls_to_jsondict( runs, lumis ):
+    ### convert (equally long) arrays of run numbers and lumisection numbers to a json dict
+    # equivalent to tuplelist_to_jsondict on a list of (run number, [sorted lumisection numbers]),
+    # but for all runs at once using numpy, which is much faster for large arrays.
+    # note: the combinations do not need to be sorted, and duplicate combinations are ignored.
+    # note: as in tuplelist_to_jsondict, a run with a single negative lumisection number
+    #       is written as [[lumisection number]] (i.e. the all-lumisections convention).
+    runs = np.asarray(runs, dtype=np.int64)
+    lumis = np.asarray(lumis, dtype=np.int64)
+    if len(runs)==0: return {}
+    # sort and remove duplicates in a single step, using combined run/lumi keys
+    keys = np.sort( LumiMask.make_keys(runs, lumis) )
+    keys = keys[np.append(True, keys[1:]!=keys[:-1])]
+    (runs, lumis) = ( (keys >> 32), (keys & 0xFFFFFFFF) + LumiMask.lumimin )
+    # find the ranges of consecutive lumisections within each run
+    newrun = np.ones(len(runs), dtype=bool)
+    newrun[1:] = (runs[1:]!=runs[:-1])
+    newrange = newrun.copy()
+    newrange[1:] |= (lumis[1:]!=lumis[:-1]+1)
+    firsts = np.flatnonzero(newrange)
+    lasts = np.append(firsts[1:]-1, len(runs)-1)
+    # find the runs with a single negative lumisection number
+    runstarts = np.flatnonzero(newrun)
+    runsizes = np.diff(np.append(runstarts, len(runs)))
+    single = np.zeros(len(runs), dtype=bool)
+    single[runstarts] = (runsizes==1) & (lumis[runstarts]<0)
+    jsondict = {}
+    for run, start, stop, issingle in zip(runs[firsts].tolist(), lumis[firsts].tolist(),
+                                          lumis[lasts].tolist(), single[firsts].tolist()):
+        lumirange = [start] if issingle else [start, stop]
+        jsondict.setdefault(str(run), []).append(lumirange)
+    return jsondict
+
+def jsondict_to_runsls( jsondict ):
+    ### inverse function of runsls_to_jsondict
+    # output:
+    # - a tuple of two numpy arrays (run numbers and lumisection numbers),
+    #   equivalent to the flattened output of jsondict_to_tuplelist
+    #   (in particular, a run with the [-1] convention results in a single lumisection number -1)
+    runs = []
+    starts = []
+    stops = []
+    for runnb, lumiranges in jsondict.items():
+        if( len(lumiranges)==1 and len(lumiranges[0])==1 and lumiranges[0][0]<0 ):
+            runs.append(int(runnb)); starts.append(lumiranges[0][0]); stops.append(lumiranges[0][0])
+            continue
+        for el in lumiranges:
+            if len(el)!=2:
+                raise Exception('ERROR in json_utils.py / jsondict_to_runsls: found range specifier with length {}'.format(len(el))
+                               +' while 2 is required [first, last]')
+            runs.append(int(runnb)); starts.append(el[0]); stops.append(el[1])
+    lengths = np.maximum(np.array(stops, dtype=np.int64)-np.array(starts, dtype=np.int64)+1, 0)
+    return ( np.repeat(np.array(runs, dtype=np.int64), lengths), expand_ranges(starts, stops) )